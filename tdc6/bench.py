@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import sys
+import time
+import tempfile
+import contextlib
+import tracemalloc
+
+import numpy as np
+
+from . import tdc_defines as defines
+from . import tdc_backend
+from . import util
+from .tdc_backend import (TDCDevice, TRecievedData, b_frame, UNSHIFT_SYMBOL,
+                          checksum)
+from .emulator import TEmulatedDevice
+from .capture import TCaptureReader, TCaptureWriter, channels_fname
+from .packed import CODECS, TPackedReader, TPackedWriter
+from .parallel import parallel_binned
+
+"""======================== BENCHMARK HELPERS ========================"""
+
+
+def best_time(f, *args, repeat=5):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f(*args)
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def report(name, **values):
+    sys.stderr.write("%-24s %s\n" % (name, "  ".join(
+        "%s=%.4g" % kv for kv in values.items())))
+
+
+@contextlib.contextmanager
+def quiet():
+    # Switch off debug output and progress dots
+    debug = tdc_backend.DEBUG, util.DEBUG
+    tdc_backend.DEBUG = util.DEBUG = False
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            yield
+    finally:
+        tdc_backend.DEBUG, util.DEBUG = debug
+
+
+def run_stage(f, *args, trace=False):
+    if trace:
+        tracemalloc.start()
+    t = time.perf_counter()
+    try:
+        f(*args)
+    finally:
+        t = time.perf_counter() - t
+        peak = tracemalloc.get_traced_memory()[1] if trace else 0
+        if trace:
+            tracemalloc.stop()
+    return t, peak
+
+
+def emulated_collector(rates, seed=0):
+    tdc = TDCDevice(transport=TEmulatedDevice(rates=rates, seed=seed))
+    tdc.reset_pointers()
+    collector = util.TDataCollector(tdc, calibration=True)
+    # Uniform ADC codes of emulator give linear calibration
+    collector.CAHS = {ch: np.linspace(1, 0, defines.ADC_CAPACITY)
+                      for ch in range(1, defines.CHANNELS_NUMBER + 1)}
+    return collector
+
+
+def random_frame(size=defines.BUFF_SIZE, seed=0):
+    # Uniform bytes have ~1% of special symbols to be stuffed
+    rng = np.random.default_rng(seed)
+    return bytearray(b_frame(rng.integers(0, 0x100, size, np.uint8).tobytes()))
+
+
+def legacy_deframe(_rdata):
+    # Former TRecievedData.__init__ unstuffing with bytearray.pop(0)
+    _rdata = bytearray(_rdata)
+    _rdata.pop(0)
+    _rdata.pop()
+    if _rdata[-2] != defines.ByteConstants.SHIFT:
+        chsum = _rdata.pop()
+    else:
+        chsum = UNSHIFT_SYMBOL(_rdata.pop())
+        _rdata.pop()
+    rdata = bytearray()
+    while _rdata:
+        c = _rdata.pop(0)
+        if c == defines.ByteConstants.SHIFT:
+            rdata.append(UNSHIFT_SYMBOL(_rdata.pop(0)))
+        else:
+            rdata.append(c)
+    if checksum(rdata) != chsum:
+        raise ValueError("Data checksum mismatch")
+    return rdata
+
+
+"""============================ BENCHMARKS ============================"""
+
+
+def bench_deframing(size=defines.BUFF_SIZE, repeat=5):
+    frame = random_frame(size)
+    out = np.empty(size, np.uint8)
+    debug, tdc_backend.DEBUG = tdc_backend.DEBUG, False
+    try:
+        if bytes(legacy_deframe(frame)) != bytes(TRecievedData(frame, out=out).rdata):
+            raise ValueError("Deframing: results of implementations differ")
+        t_legacy = best_time(legacy_deframe, frame, repeat=repeat)
+        t_new = best_time(TRecievedData, frame, out, repeat=repeat)
+    finally:
+        tdc_backend.DEBUG = debug
+    report("deframing %d B" % len(frame),
+           legacy_ms=t_legacy * 1e3, vectorized_ms=t_new * 1e3,
+           speedup=t_legacy / t_new,
+           MBps=len(frame) / t_new / 1e6)
+
+
+def bench_pipeline(events_count=500000, rate=1e6, seed=0):
+    """Events/s and peak memory of every stage of acquisition
+    from the emulated board. Time and memory are measured in separate
+    runs because tracemalloc slows down Python code."""
+    rates = [rate / defines.CHANNELS_NUMBER] * defines.CHANNELS_NUMBER
+    fname = os.path.join(tempfile.mkdtemp(), "bench.tdc")
+    results = {}
+    for trace in (False, True):
+        with quiet():
+            collector = emulated_collector(rates, seed)
+            stages = [
+                ("read_by_count", collector.read_by_count, events_count),
+                ("collect_events_data", collector.collect_events_data),
+                ("make_binned_data", collector.make_binned_data),
+                ("save_data", collector.save_data, fname)]
+            for name, f, *args in stages:
+                t, peak = run_stage(f, *args, trace=trace)
+                if trace:
+                    results[name]["peak_MB"] = peak / 1e6
+                else:
+                    results[name] = {"time_s": t}
+            n = len(collector.events_data)
+        for name in results:
+            results[name].setdefault("events_per_s", n / results[name]["time_s"])
+    os.remove(fname)
+    os.remove(channels_fname(fname))
+    os.remove(channels_fname(fname, defines.CAPTURE_INDEX_SUFFIX))
+    for name, values in results.items():
+        report(name, events=n, **values)
+    return results
+
+
+def bench_parallel_decode(events_count=1000000, rate=1e6, seed=0):
+    # Offline decoding of acquired raw blocks by 1, 2, ... cpu_count processes
+    rates = [rate / defines.CHANNELS_NUMBER] * defines.CHANNELS_NUMBER
+    with quiet():
+        collector = emulated_collector(rates, seed)
+        collector.read_by_count(events_count)
+        t_serial, _ = run_stage(lambda: (collector.collect_events_data(),
+                                         collector.make_binned_data()))
+        workers, times = 1, {}
+        while workers <= os.cpu_count():
+            t = time.perf_counter()
+            binned = parallel_binned(collector.data, collector.CAHS, workers)
+            times[workers] = time.perf_counter() - t
+            if not np.array_equal(binned, collector.binned_data):
+                raise ValueError("Decoding: parallel result differs")
+            workers *= 2
+    n = len(collector.binned_data)
+    report("serial decode", events=n, events_per_s=n / t_serial)
+    for workers, t in times.items():
+        report("parallel decode x%d" % workers, events=n, events_per_s=n / t,
+               speedup=t_serial / t)
+
+
+def bench_query(events_count=4000000, duration=3600., window=1., seed=0):
+    """Loading of a window of seconds, and of one channel in it, from
+    a capture of duration seconds, with a fresh reader every time"""
+    rng = np.random.default_rng(seed)
+    fname = os.path.join(tempfile.mkdtemp(), "query.tdc")
+    with TCaptureWriter(fname) as f:
+        for start in range(0, events_count, defines.CAPTURE_INDEX_CHUNK * 4):
+            n = min(defines.CAPTURE_INDEX_CHUNK * 4, events_count - start)
+            batch = np.empty(n, tdc_backend.BINNED_DTYPE)
+            batch['bin'] = (start + np.arange(n)) * (duration * 1e12 / events_count)
+            batch['ch'] = rng.integers(1, defines.CHANNELS_NUMBER + 1, n)
+            f.write(batch)
+    t0 = int(duration / 2 * 1e12)
+    t1 = t0 + int(window * 1e12)
+    bins = np.fromfile(fname, '<i8', offset=defines.CAPTURE_HEADER_SIZE)
+    chs = np.fromfile(channels_fname(fname), np.uint8)
+    for name, channels in (("query window", None), ("query window ch1", [1])):
+        selected = (bins >= t0) & (bins < t1)
+        if channels is not None:
+            selected &= np.isin(chs, channels)
+        t = best_time(lambda: TCaptureReader(fname).query(t0, t1, channels))
+        found = TCaptureReader(fname).query(t0, t1, channels)
+        if not np.array_equal(found['bin'], bins[selected]):
+            raise ValueError("Query: result differs from full scan")
+        report(name, events=len(found), capture_events=events_count, ms=t * 1e3)
+    for suffix in ("", defines.CAPTURE_CHANNELS_SUFFIX, defines.CAPTURE_INDEX_SUFFIX):
+        os.remove(fname + suffix)
+
+
+def bench_packed(events_count=2000000, rate=1e6, seed=0):
+    """Compression ratio against binary capture (9 bytes per event) and
+    encode/decode MB/s of binary capture data for every codec"""
+    rng = np.random.default_rng(seed)
+    binned = np.empty(events_count, tdc_backend.BINNED_DTYPE)
+    binned['bin'] = np.cumsum(rng.exponential(1e12 / rate, events_count)).astype(np.int64)
+    binned['ch'] = rng.integers(1, defines.CHANNELS_NUMBER + 1, events_count)
+    raw_size = events_count * 9
+    fname = os.path.join(tempfile.mkdtemp(), "bench.tdz")
+    for codec in CODECS:
+        def encode():
+            with TPackedWriter(fname, codec=codec) as f:
+                f.write(binned)
+        t_encode = best_time(encode, repeat=3)
+        reader = TPackedReader(fname)
+        t_decode = best_time(reader.binned, 1, repeat=3)
+        t_parallel = best_time(reader.binned, None, repeat=3)
+        if not np.array_equal(reader.binned(), binned):
+            raise ValueError("Packing: decoded events differ")
+        report("packed %s" % codec, events=events_count,
+               ratio=raw_size / os.path.getsize(fname),
+               encode_MBps=raw_size / t_encode / 1e6,
+               decode_MBps=raw_size / t_decode / 1e6,
+               parallel_decode_MBps=raw_size / t_parallel / 1e6)
+    os.remove(fname)
+
+
+# Fresh interpreter: imports of a headless acquisition and the first read
+STARTUP_SCRIPT = """
+import time
+launch = time.perf_counter()
+import io, sys, contextlib
+import tdc6.util, tdc6.calibration
+from tdc6.tdc_backend import TDCDevice
+from tdc6.emulator import TEmulatedDevice
+with contextlib.redirect_stdout(io.StringIO()):
+    tdc = TDCDevice(transport=TEmulatedDevice())
+    tdc.reset_pointers()
+    collector = tdc6.util.TDataCollector(tdc, calibration=True)
+    collector.read_by_pointers()
+print(collector.first_read - launch, 'matplotlib' in sys.modules)
+"""
+
+
+def bench_startup(repeat=5, limit=None):
+    """Time to first read of a new process with the emulated board.
+    Plotting must not be loaded on this path, limit (s) fails slow start."""
+    import subprocess
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        os.environ.get("PYTHONPATH", "").split(os.pathsep)))
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], env=env,
+                             capture_output=True, text=True, check=True).stdout.split()
+        if out[1] != "False":
+            raise ValueError("Startup: plotting is imported by headless acquisition")
+        times.append(float(out[0]))
+    report("time to first read", best_ms=min(times) * 1e3,
+           median_ms=float(np.median(times)) * 1e3)
+    if limit is not None and min(times) > limit:
+        raise ValueError("Startup: first read after %.3f s > %.3f s" % (min(times), limit))
+    return min(times)
+
+
+BENCHMARKS = [bench_startup, bench_deframing, bench_pipeline, bench_parallel_decode,
+              bench_query, bench_packed]
+
+
+if __name__ == "__main__":
+    for bench in BENCHMARKS:
+        bench()
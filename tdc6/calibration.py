@@ -1,41 +1,182 @@
 # -*- coding: utf-8 -*-
+import os
+import pickle
+import struct
+import hashlib
+
 import numpy as np
-import matplotlib.pyplot as plt
 from . import tdc_defines as defines
 
 DEBUG = True
+# Show histogram and CF table of new calibration, blocks until closed
+PLOT = False
+
+"""===================== CALIBRATION TABLE FORMAT =====================
+    header      magic, version, channel, events count, ADC capacity,
+                SHA-256 of channel, count, CF table and histogram
+    CF table    float64[ADC_CAPACITY]
+    histogram   uint64[ADC_CAPACITY]"""
+
+HEADER_FORMAT = "<8sIIQI32s"
+
+# Tables loaded by any collector, {fname: (mtime, size, helper)}
+_LOADED = {}
+
+
+def make_histogram(adcd):
+    return np.bincount(adcd, minlength=defines.ADC_CAPACITY)[
+        :defines.ADC_CAPACITY].astype(np.float64)
+
+
+def make_cf_table(histogram):
+    # CF[n] = 1 - sum(histogram[:n]) / N for all n at once
+    if not np.sum(histogram):
+        raise ValueError("Calibration: Histogram is empty")
+    prefix = np.zeros(defines.ADC_CAPACITY)
+    prefix[1:] = np.cumsum(histogram)[:-1]
+    return 1 - prefix / np.sum(histogram)
 
 
 class TCalibrationHelper:
 
     ch = None
-    zeros = np.zeros(defines.ADC_CAPACITY)
 
     def __init__(self, ch, events):
         if ch < 1 or ch > defines.CHANNELS_NUMBER + 1:
             raise ValueError(
                 "Calibration: Channel to calibrate must be number from 1 to %d"
-                % defines.CHANNELS_NUMBER + 1)
-        if not events:
+                % (defines.CHANNELS_NUMBER + 1))
+        if not len(events):
             raise ValueError("Calibration: No data were registered")
-        self.ch = ch
-        self.events = [e.adcd for e in events if e.ch == ch]
-        if not self.events:
+        adcd = events['adcd'][events['ch'] == ch]
+        if not len(adcd):
             raise ValueError(
                 "Calibration: No data for channel %d were registered" % ch)
-        self.N = len(self.events)
-        self._make_histogram()
-
-    def _make_histogram(self):
-        self.histogram = np.copy(self.zeros)
-        for adcd in self.events:
-            self.histogram[adcd] += 1
-        print(self.histogram)
+        self._set_histogram(ch, make_histogram(adcd))
         if DEBUG:
+            print(self.histogram)
+        if PLOT:
+            # Plotting is loaded only when asked for, headless runs start faster
+            import matplotlib.pyplot as plt
             plt.plot(self.histogram)
-            X = np.arange(defines.ADC_CAPACITY)
-            plt.plot(X, np.vectorize(self.CF)(X))
+            plt.plot(np.arange(defines.ADC_CAPACITY), self.cf)
             plt.show()
 
+    @classmethod
+    def from_histogram(cls, ch, histogram):
+        self = cls.__new__(cls)
+        self._set_histogram(ch, np.asarray(histogram, np.float64))
+        return self
+
+    def _set_histogram(self, ch, histogram):
+        self.ch = ch
+        self.histogram = histogram
+        self.N = int(np.sum(histogram))
+        self.cf = make_cf_table(histogram)
+        self.digest = self._digest()
+
+    def _digest(self):
+        h = hashlib.sha256(struct.pack("<IQ", self.ch, self.N))
+        h.update(self.cf.astype('<f8').tobytes())
+        h.update(self.histogram.astype('<u8').tobytes())
+        return h.digest()
+
     def CF(self, n):
-        return 1 - np.sum(self.histogram[:n]) / self.N
+        return self.cf[n]
+
+    def save(self, fname):
+        os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+        with open(fname, "wb") as f:
+            f.write(struct.pack(HEADER_FORMAT, defines.CALIBRATION_MAGIC,
+                                defines.CALIBRATION_VERSION, self.ch, self.N,
+                                defines.ADC_CAPACITY, self.digest))
+            f.write(self.cf.astype('<f8').tobytes())
+            f.write(self.histogram.astype('<u8').tobytes())
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, "rb") as f:
+            data = f.read()
+        size = struct.calcsize(HEADER_FORMAT)
+        if len(data) < size:
+            raise ValueError("Calibration: %s is truncated" % fname)
+        magic, version, ch, N, capacity, digest = struct.unpack(
+            HEADER_FORMAT, data[:size])
+        if magic != defines.CALIBRATION_MAGIC:
+            raise ValueError("Calibration: %s is not a calibration table" % fname)
+        if version != defines.CALIBRATION_VERSION:
+            raise ValueError(
+                "Calibration: unsupported version %d of %s" % (version, fname))
+        if capacity != defines.ADC_CAPACITY or len(data) != size + 16 * capacity:
+            raise ValueError("Calibration: %s has wrong size" % fname)
+        self = cls.__new__(cls)
+        self.ch, self.N, self.digest = ch, N, digest
+        self.cf = np.frombuffer(data, '<f8', capacity, size).astype(np.float64)
+        self.histogram = np.frombuffer(
+            data, '<u8', capacity, size + 8 * capacity).astype(np.float64)
+        if self._digest() != digest:
+            raise ValueError("Calibration: %s is corrupted" % fname)
+        return self
+
+
+def calibration_table(ch, serial=None):
+    # Every board of a multi-device setup has its own tables
+    if serial is None:
+        return defines.CALIBRATION_TABLE % ch
+    return defines.DEVICE_CALIBRATION_TABLE % (serial, ch)
+
+
+def load_calibration(ch, serial=None):
+    """Calibration helper of the channel, loaded once per process.
+    Helpers pickled by former versions are converted to tables."""
+    fname = calibration_table(ch, serial)
+    if serial is None and not os.path.exists(fname) and \
+            os.path.exists(defines.CALIBRATION_HELPER % ch):
+        with open(defines.CALIBRATION_HELPER % ch, "rb") as f:
+            TCalibrationHelper.from_histogram(ch, pickle.load(f).histogram).save(fname)
+    stat = os.stat(fname)
+    key = stat.st_mtime_ns, stat.st_size
+    if fname not in _LOADED or _LOADED[fname][0] != key:
+        _LOADED[fname] = key, TCalibrationHelper.load(fname)
+    return _LOADED[fname][1]
+
+
+class TOnlineCalibration:
+    """ADC histograms accumulated from the live event stream.
+    Old events fade out exponentially with half_life (in events of the
+    channel). When CF table of a channel drifts from the one in use by
+    more than max_drift, the new table replaces it in CAHS."""
+
+    def __init__(self, half_life=defines.HIST_CAPACITY,
+                 max_drift=defines.ONLINE_CALIBRATION_DRIFT,
+                 min_events=defines.HIST_CAPACITY):
+        self.half_life = half_life
+        self.max_drift = max_drift
+        self.min_events = min_events
+        self.histograms = {}
+        self.counts = {}
+        self.drifts = {}
+        self.swaps = 0
+
+    def update(self, events, cahs):
+        for ch in np.unique(events['ch']).tolist():
+            adcd = events['adcd'][events['ch'] == ch]
+            decay = 0.5 ** (len(adcd) / self.half_life)
+            histogram = self.histograms.get(ch, np.zeros(defines.ADC_CAPACITY))
+            self.histograms[ch] = decay * histogram + make_histogram(adcd)
+            self.counts[ch] = self.counts.get(ch, 0) + len(adcd)
+            if self.counts[ch] < self.min_events:
+                continue
+            cf = make_cf_table(self.histograms[ch])
+            self.drifts[ch] = np.max(np.abs(cf - cahs[ch])) if ch in cahs else np.inf
+            if self.drifts[ch] > self.max_drift:
+                # Binning takes the table once per batch, so replacing
+                # the whole array is enough for consistency
+                cahs[ch] = cf
+                self.swaps += 1
+
+    def save(self, serial=None):
+        for ch, histogram in self.histograms.items():
+            if self.counts[ch] >= self.min_events:
+                TCalibrationHelper.from_histogram(ch, np.round(histogram)).save(
+                    calibration_table(ch, serial))
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import struct
+import hashlib
+
+import numpy as np
+
+from . import tdc_defines as defines
+from . import metrics
+from .tdc_backend import (BINNED_DTYPE, DEVICE_BINNED_DTYPE, TDC_ERROR_TEMPLATE,
+                          b_cf_table)
+
+"""====================== BINARY CAPTURE FORMAT ======================
+Capture is a pair of append-only column files:
+    fname       header (CAPTURE_HEADER_SIZE bytes) + int64 timestamps, ps
+    fname.ch    uint8 channel numbers
+    fname.dev   uint8 board indices, only for multi-device captures
+    fname.idx   INDEX_DTYPE records of time-ordered chunks
+    fname.cal   calibration swaps, see TCalibrationLog
+Header is magic, version, JSON length and JSON metadata.
+Events count follows from the file sizes, so an interrupted run
+is still readable up to the last written event.
+
+Sparse index has a record per CAPTURE_INDEX_CHUNK events: position,
+first and last timestamp and counts of every channel. Queries of time
+ranges and channels read only the chunks which may hold the events,
+events past the index (interrupted run, older capture) are indexed
+when the reader needs them."""
+
+HEADER_FORMAT = "<8sII"
+
+# Channel numbers are in [1, CHANNELS_NUMBER + 1], see b_events
+INDEX_CHANNELS = defines.CHANNELS_NUMBER + 2
+
+INDEX_DTYPE = np.dtype([
+    ('start', '<i8'),
+    ('count', '<i8'),
+    ('first', '<i8'),
+    ('last', '<i8'),
+    ('chs', '<i8', (INDEX_CHANNELS,))])
+
+
+def calibration_id(cahs):
+    if not cahs:
+        return None
+    return hashlib.sha1(b_cf_table(cahs).tobytes()).hexdigest()
+
+
+def channels_fname(fname, suffix=defines.CAPTURE_CHANNELS_SUFFIX):
+    if fname == os.devnull:
+        return os.devnull
+    return fname + suffix
+
+
+def pack_header(metadata, magic=defines.CAPTURE_MAGIC):
+    meta = json.dumps(metadata).encode('utf-8')
+    header = struct.pack(HEADER_FORMAT, magic,
+                         defines.CAPTURE_VERSION, len(meta)) + meta
+    if len(header) > defines.CAPTURE_HEADER_SIZE:
+        raise ValueError(TDC_ERROR_TEMPLATE % "Capture metadata is too long")
+    return header.ljust(defines.CAPTURE_HEADER_SIZE, b'\x00')
+
+
+def unpack_header(header, expected_magic=defines.CAPTURE_MAGIC):
+    size = struct.calcsize(HEADER_FORMAT)
+    if len(header) < size:
+        raise ValueError(TDC_ERROR_TEMPLATE % "Capture header is truncated")
+    magic, version, meta_len = struct.unpack(HEADER_FORMAT, header[:size])
+    if magic != expected_magic:
+        raise ValueError(TDC_ERROR_TEMPLATE % "Not a TDC6 capture")
+    if version != defines.CAPTURE_VERSION:
+        raise ValueError(TDC_ERROR_TEMPLATE %
+                         "Unsupported capture version %d" % version)
+    return json.loads(header[size:size + meta_len].decode('utf-8'))
+
+
+class TCalibrationLog:
+    """Calibration of the events being written. Header of a capture has
+    calibration_id of the tables at its opening, TOnlineCalibration may
+    replace them later. Every replacement is appended to fname.cal as a
+    line of the position of the first event written after it and the
+    new calibration_id."""
+
+    def __init__(self, fname, cahs):
+        self.fname = channels_fname(fname, defines.CAPTURE_CALIBRATION_SUFFIX)
+        self.cahs = cahs
+        # Swapped tables are new arrays, so they are told by identity
+        self.tables = dict(cahs or {})
+        open(self.fname, "w").close()
+
+    def check(self, position):
+        if not self.cahs or (len(self.cahs) == len(self.tables) and all(
+                self.cahs.get(ch) is cf for ch, cf in self.tables.items())):
+            return
+        self.tables = dict(self.cahs)
+        with open(self.fname, "a") as f:
+            f.write("%d\t%s\n" % (position, calibration_id(self.tables)))
+
+
+def read_calibrations(fname, metadata):
+    """[(position, calibration_id)] of a capture, events from position
+    on are binned by the tables, the last of equal positions holds"""
+    calibrations = [(0, metadata.get('calibration'))]
+    cal_fname = channels_fname(fname, defines.CAPTURE_CALIBRATION_SUFFIX)
+    if os.path.exists(cal_fname):
+        with open(cal_fname) as f:
+            for line in f:
+                position, calibration = line.split()
+                calibrations.append((int(position), calibration))
+    return calibrations
+
+
+def b_index(bins, chs, start=0, chunk=defines.CAPTURE_INDEX_CHUNK):
+    # Index records of ordered events, start is position of the first one
+    starts = np.arange(0, len(bins), chunk)
+    index = np.zeros(len(starts), INDEX_DTYPE)
+    if not len(bins):
+        return index
+    stops = np.minimum(starts + chunk, len(bins))
+    index['start'] = start + starts
+    index['count'] = stops - starts
+    index['first'] = bins[starts]
+    index['last'] = bins[stops - 1]
+    slots = np.arange(len(bins)) // chunk * INDEX_CHANNELS + chs
+    index['chs'] = np.bincount(slots, minlength=len(starts) * INDEX_CHANNELS).reshape(
+        len(starts), INDEX_CHANNELS)
+    return index
+
+
+class TCaptureWriter:
+    """Writer of time-ordered BINNED_DTYPE batches. With devices, a list
+    of {'serial', 'calibration'} of the boards, it writes
+    DEVICE_BINNED_DTYPE batches."""
+
+    def __init__(self, fname, cahs=None, devices=None, **metadata):
+        self.fname = fname
+        self.count = 0
+        self.metadata = dict(
+            bin_timelen=defines.BIN_TIMELEN,
+            calibration=calibration_id(cahs),
+            created=time.time(),
+            run=metadata)
+        self.files = [open(fname, "wb"), open(channels_fname(fname), "wb")]
+        self.columns = [('bin', '<i8'), ('ch', np.uint8)]
+        if devices is not None:
+            self.metadata['devices'] = devices
+            self.files.append(
+                open(channels_fname(fname, defines.CAPTURE_DEVICES_SUFFIX), "wb"))
+            self.columns.append(('dev', np.uint8))
+        self.files[0].write(pack_header(self.metadata))
+        self.calibration_log = TCalibrationLog(fname, cahs)
+        self.index_file = open(channels_fname(fname, defines.CAPTURE_INDEX_SUFFIX), "wb")
+        # Events of the chunk being filled, indexed when it is full
+        self.pending = []
+        self.pending_count = 0
+        self.indexed = 0
+
+    def write(self, binned):
+        t = metrics.start()
+        self.calibration_log.check(self.count)
+        for f, (name, dtype) in zip(self.files, self.columns):
+            f.write(np.ascontiguousarray(binned[name], dtype).tobytes())
+        self.pending.append(binned[['bin', 'ch']])
+        self.pending_count += len(binned)
+        if self.pending_count >= defines.CAPTURE_INDEX_CHUNK:
+            self._write_index(False)
+        self.count += len(binned)
+        metrics.stop("write_seconds", t)
+        metrics.inc("events_written", len(binned))
+
+    def _write_index(self, last):
+        # Whole chunks are indexed, the last one may be partial
+        pending = np.concatenate(self.pending) if self.pending else np.empty(0, BINNED_DTYPE)
+        n = len(pending) if last else \
+            len(pending) - len(pending) % defines.CAPTURE_INDEX_CHUNK
+        self.index_file.write(
+            b_index(pending['bin'][:n], pending['ch'][:n], self.indexed).tobytes())
+        self.indexed += n
+        self.pending = [pending[n:]]
+        self.pending_count = len(pending) - n
+
+    def flush(self):
+        for f in self.files + [self.index_file]:
+            f.flush()
+
+    def close(self):
+        if not self.index_file.closed:
+            self._write_index(True)
+        for f in self.files + [self.index_file]:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def _memmap(fname, dtype, offset, count):
+    if not count:
+        return np.empty(0, dtype)
+    return np.memmap(fname, dtype, 'r', offset=offset, shape=(count,))
+
+
+class TCaptureReader:
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as f:
+            self.metadata = unpack_header(f.read(defines.CAPTURE_HEADER_SIZE))
+        bins_size = os.path.getsize(fname) - defines.CAPTURE_HEADER_SIZE
+        self.count = min(bins_size // 8, os.path.getsize(channels_fname(fname)))
+        self.devices = self.metadata.get('devices')
+        if self.devices is not None:
+            devs_fname = channels_fname(fname, defines.CAPTURE_DEVICES_SUFFIX)
+            self.count = min(self.count, os.path.getsize(devs_fname))
+        # Columns are mapped, not read
+        self.bins = _memmap(fname, '<i8', defines.CAPTURE_HEADER_SIZE, self.count)
+        self.chs = _memmap(channels_fname(fname), np.uint8, 0, self.count)
+        self.devs = None
+        if self.devices is not None:
+            self.devs = _memmap(devs_fname, np.uint8, 0, self.count)
+        self._index = None
+        self.calibrations = read_calibrations(fname, self.metadata)
+
+    def __len__(self):
+        return self.count
+
+    def binned(self, start=0, stop=None):
+        # Copy of events [start, stop) as BINNED_DTYPE array,
+        # DEVICE_BINNED_DTYPE for multi-device captures
+        bins, chs = self.bins[start:stop], self.chs[start:stop]
+        if self.devs is None:
+            binned = np.empty(len(bins), BINNED_DTYPE)
+        else:
+            binned = np.empty(len(bins), DEVICE_BINNED_DTYPE)
+            binned['dev'] = self.devs[start:stop]
+        binned['bin'] = bins
+        binned['ch'] = chs
+        return binned
+
+    @property
+    def index(self):
+        """INDEX_DTYPE records of all events of the capture"""
+        if self._index is None:
+            index_fname = channels_fname(self.fname, defines.CAPTURE_INDEX_SUFFIX)
+            index = np.empty(0, INDEX_DTYPE)
+            if os.path.exists(index_fname):
+                index = np.fromfile(index_fname, INDEX_DTYPE)
+                # Records of chunks not written completely are rebuilt
+                index = index[index['start'] + index['count'] <= self.count]
+            indexed = int(index['start'][-1] + index['count'][-1]) if len(index) else 0
+            self._index = np.concatenate([index, b_index(
+                self.bins[indexed:], self.chs[indexed:], indexed)])
+        return self._index
+
+    def query(self, start=None, stop=None, channels=None):
+        """Events with start <= bin < stop (ps) of channels (numbers),
+        as binned() gives. Only chunks which may hold them are read."""
+        index = self.index
+        selected = np.ones(len(index), np.bool_)
+        if start is not None:
+            selected &= index['last'] >= start
+        if stop is not None:
+            selected &= index['first'] < stop
+        if channels is not None:
+            channels = np.asarray(list(channels), np.int64)
+            selected &= index['chs'][:, channels].sum(axis=1) > 0
+        parts = []
+        for chunk in index[selected]:
+            lo, hi = int(chunk['start']), int(chunk['start'] + chunk['count'])
+            bins = self.bins[lo:hi]
+            if start is not None and chunk['first'] < start:
+                lo += int(np.searchsorted(bins, start, 'left'))
+            if stop is not None and chunk['last'] >= stop:
+                hi = int(chunk['start']) + int(np.searchsorted(bins, stop, 'left'))
+            binned = self.binned(lo, hi)
+            if channels is not None:
+                binned = binned[np.isin(binned['ch'], channels)]
+            parts.append(binned)
+        if not parts:
+            return self.binned(0, 0)
+        return np.concatenate(parts)
+
+
+def export_text(fname, txt_fname, chunk=0x100000):
+    # Same text format as the former TDataCollector.save_data
+    reader = TCaptureReader(fname)
+    # Board index is the third column of multi-device captures
+    fmt = '%d\t%d' if reader.devs is None else '%d\t%d\t%d'
+    with open(txt_fname, "w") as f:
+        for start in range(0, len(reader), chunk):
+            lines = [fmt % T for T in reader.binned(start, start + chunk).tolist()]
+            f.write(('\n' if start else '') + '\n'.join(lines))
+    return len(reader)
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 3:
+        sys.exit("Usage: python -m tdc6.capture CAPTURE TEXT_FILE")
+    sys.stderr.write("%d EVENTS ARE EXPORTED TO '%s'\n" %
+                     (export_text(*sys.argv[1:]), sys.argv[2]))
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from . import tdc_defines as defines
+from .tdc_backend import BINNED_DTYPE
+
+# Events of one channel matched at once, bounds memory of pair indices
+MATCH_CHUNK = 0x100000
+
+
+def FWHM(X, Y):
+    half_max = np.max(Y) / 2.
+    # left and right most points at or above half maximum
+    d = np.where(Y - half_max >= 0)[0]
+    return X[d[-1]] - X[d[0]]
+
+
+def pair_differences(t1, t2, window, new1=None, new2=None, same=False):
+    """All differences t2 - t1 within [-window, window] for sorted t1, t2.
+    If new1/new2 masks are given, pairs of two old events are skipped.
+    For the same channel (t1 is t2) every pair is taken once, t2 >= t1."""
+    for start in range(0, len(t1), MATCH_CHUNK):
+        ta = t1[start:start + MATCH_CHUNK]
+        lo = np.searchsorted(t2, ta - window, 'left')
+        hi = np.searchsorted(t2, ta + window, 'right')
+        counts = hi - lo
+        ia = np.repeat(np.arange(len(ta)), counts)
+        # Position of every match inside its [lo, hi) range
+        ib = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + \
+            np.repeat(lo, counts)
+        keep = ib > ia + start if same else np.ones(len(ia), np.bool_)
+        if new1 is not None:
+            keep &= new1[start:start + MATCH_CHUNK][ia] | new2[ib]
+        ia, ib = ia[keep], ib[keep]
+        yield t2[ib] - ta[ia]
+
+
+class TCoincidenceCounter:
+    """Fixed-bin histograms of time differences t(ch2) - t(ch1) for every
+    channel pair within +-window picoseconds. Batches of BINNED_DTYPE
+    must come in time order; events near the end of a batch are kept
+    to be matched with the next one."""
+
+    def __init__(self, pairs, window=defines.COINCIDENCE_WINDOW,
+                 bins=defines.COINCIDENCE_BINS):
+        if window <= 0:
+            raise ValueError("Coincidence: window must be positive")
+        self.pairs = [tuple(pair) for pair in pairs]
+        self.window = int(window)
+        self.bins = bins
+        self.edges = np.linspace(-self.window, self.window, bins + 1)
+        self.counts = {pair: np.zeros(bins, np.int64) for pair in self.pairs}
+        self.carry = np.empty(0, BINNED_DTYPE)
+
+    def update(self, binned):
+        if not len(binned):
+            return
+        data = np.concatenate([self.carry, binned])
+        new = np.arange(len(data)) >= len(self.carry)
+        for ch1, ch2 in self.pairs:
+            m1, m2 = data['ch'] == ch1, data['ch'] == ch2
+            for dt in pair_differences(data['bin'][m1], data['bin'][m2],
+                                       self.window, new[m1], new[m2],
+                                       same=ch1 == ch2):
+                self._accumulate((ch1, ch2), dt)
+        last = data['bin'][-1]
+        self.carry = data[np.searchsorted(data['bin'], last - self.window, 'left'):]
+
+    def _accumulate(self, pair, dt):
+        # Same bins as np.histogram with self.edges: right edge is inclusive
+        idx = (dt + self.window) * self.bins // (2 * self.window)
+        self.counts[pair] += np.bincount(
+            np.minimum(idx, self.bins - 1), minlength=self.bins)
+
+    def histogram(self, ch1, ch2):
+        return self.counts[(ch1, ch2)], self.edges
+
+    def fwhm(self, ch1, ch2):
+        counts, edges = self.histogram(ch1, ch2)
+        if not counts.any():
+            return np.nan
+        return FWHM(edges, counts)
+
+
+class TRateCounter:
+    """Events of every channel and their rates, events/s over the time
+    span of ordered BINNED_DTYPE batches"""
+
+    def __init__(self):
+        # Channel numbers are in [1, CHANNELS_NUMBER + 1], see b_events
+        self.counts = np.zeros(defines.CHANNELS_NUMBER + 2, np.int64)
+        self.first = None
+        self.last = None
+
+    def update(self, binned):
+        if not len(binned):
+            return
+        self.counts += np.bincount(binned['ch'], minlength=len(self.counts))
+        if self.first is None:
+            self.first = int(binned['bin'][0])
+        self.last = int(binned['bin'][-1])
+
+    @property
+    def duration(self):
+        # Seconds
+        if self.first is None:
+            return 0.
+        return (self.last - self.first) * 1e-12
+
+    def rates(self):
+        duration = self.duration
+        return {ch: int(self.counts[ch]) / duration if duration else 0.
+                for ch in range(1, len(self.counts))}
+
+
+def save_histograms(fname, counter, rates=None):
+    # Histograms of all pairs as hist_<ch1>_<ch2> of .npz archive
+    arrays = {"hist_%d_%d" % pair: counts for pair, counts in counter.counts.items()}
+    if rates is not None:
+        arrays.update(channel_counts=rates.counts, duration=rates.duration)
+    # File object keeps the name, np.savez would add .npz
+    with open(fname, "wb") as f:
+        np.savez(f, edges=counter.edges, **arrays)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import time
+
+import numpy as np
+import ftd2xx as ftd
+
+from . import tdc_defines as defines
+from .tdc_backend import b_frame, UNSHIFT_SYMBOL, UNPACK_NUM
+
+"""=================== EMULATED TDC6 BOARD =====================
+Software model of TDC6 behind an FTDI chip. It implements the part of
+ftd2xx.FTD2XX interface used by TDCDevice, so it can be passed as
+TDCDevice(transport=TEmulatedDevice(...))."""
+
+# Argument bytes following each command code
+COMMAND_ARGS = {
+    defines.Commands.ECHO[0]: 0,
+    defines.Commands.GETID[0]: 0,
+    defines.Commands.RESET_POINTERS[0]: 1,
+    defines.Commands.R_BRAMBLK[0]: 4,
+    defines.Commands.W_ADDR[0]: 0,
+    defines.Commands.R_ADDR[0]: 0,
+}
+
+BOARD_ID = b'TDC6'
+
+
+def pack_events(rbin, ch, adcd, err):
+    # Inverse of tdc_backend.b_events
+    raw = np.empty((len(rbin), defines.TIMESTAMP_LEN), np.uint8)
+    for i in range(6):
+        raw[:, i] = (rbin >> 8 * i) & 0xff
+    raw[:, 6] = adcd & 0xff
+    raw[:, 7] = ((ch - 1) << 5) | (err.astype(np.uint8) << 4) | (adcd >> 8)
+    return raw.ravel()
+
+
+class TEmulatedDevice:
+
+    type = ftd.defines.DEVICE_2232H
+    description = b'TDC6 emulator'
+    status = 1
+
+    def __init__(self, rates=(1e5,) * defines.CHANNELS_NUMBER,
+                 err_rate=0., clock=time.perf_counter, seed=None, serial=b'EMU0',
+                 overwrite=False, rbin_start=0):
+        # rates: Poisson event rate per channel in events/s.
+        # Full BRAM drops new events, or with overwrite the writer laps
+        # the reader. rbin_start is timebin counter at reset of pointers
+        self.rates = np.asarray(rates, np.float64)
+        self.err_rate = err_rate
+        self.overwrite = overwrite
+        self.rbin_start = rbin_start
+        self.clock = clock
+        self.serial = serial
+        self.rng = np.random.default_rng(seed)
+        # Ring buffer addresses are [0, BUFF_SIZE), reads wrap at HADDR_BOUND
+        self.bram = np.zeros(defines.BUFF_SIZE, np.uint8)
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.dropped = 0
+        self.reset_pointers()
+
+    def reset_pointers(self):
+        self.r_pointer = 0
+        self.w_pointer = 0
+        # Lapped bytes are written - read_bytes - unread ones
+        self.written = 0
+        self.read_bytes = 0
+        self.t0 = self.clock()
+        self.last_time = 0.
+
+    """----------------------- EVENTS GENERATION -----------------------"""
+
+    def free_space(self):
+        # One byte is kept free to tell a full buffer from an empty one
+        return (self.r_pointer - self.w_pointer - 1) % defines.BUFF_SIZE
+
+    def generate(self):
+        now = self.clock() - self.t0
+        start, dt = self.last_time, now - self.last_time
+        if dt <= 0:
+            return
+        self.last_time = now
+        counts = self.rng.poisson(self.rates * dt)
+        n = int(counts.sum())
+        # Board keeps unread data and drops events when BRAM is full
+        fit = n if self.overwrite else min(n, self.free_space() // defines.TIMESTAMP_LEN)
+        self.dropped += n - fit
+        if not fit:
+            return
+        if fit < n:
+            # Only the earliest events are stored
+            dt *= fit / n
+            counts = self.rng.multinomial(fit, self.rates / self.rates.sum())
+        times = start + self.rng.random(fit) * dt
+        ch = np.repeat(np.arange(1, len(self.rates) + 1), counts)
+        order = np.argsort(times, kind='stable')
+        times, ch = times[order], ch[order]
+
+        rbin = (self.rbin_start + (times / defines.BIN_TIMELEN).astype(np.int64)) % \
+            2 ** defines.RBIN_BITS
+        adcd = self.rng.integers(0, defines.ADC_CAPACITY, fit)
+        err = self.rng.random(fit) < self.err_rate
+        self.write_bram(pack_events(rbin, ch, adcd, err))
+
+    def write_bram(self, data):
+        # Only the last BUFF_SIZE bytes of a long write stay in BRAM
+        tail = data[-defines.BUFF_SIZE:]
+        start = self.w_pointer + len(data) - len(tail)
+        idx = (start + np.arange(len(tail))) % defines.BUFF_SIZE
+        self.bram[idx] = tail
+        self.w_pointer = (self.w_pointer + len(data)) % defines.BUFF_SIZE
+        self.written += len(data)
+
+    def read_bram(self, start, size):
+        idx = (start + np.arange(size)) % defines.BUFF_SIZE
+        self.r_pointer = (start + size) % defines.BUFF_SIZE
+        self.read_bytes += size
+        return self.bram[idx].tobytes()
+
+    """------------------------ COMMAND PROTOCOL ------------------------"""
+
+    @staticmethod
+    def pointer(p):
+        return bytes([p // 0x100, p % 0x100])
+
+    def execute(self, code, args):
+        self.generate()
+        if code == defines.Commands.R_ADDR[0]:
+            # Reported read address is one byte ahead, see TDataCollector.get_pointers
+            return self.pointer(self.r_pointer + 1)
+        if code == defines.Commands.W_ADDR[0]:
+            return self.pointer(self.w_pointer)
+        if code == defines.Commands.R_BRAMBLK[0]:
+            return self.read_bram(UNPACK_NUM(args[:2]), UNPACK_NUM(args[2:]))
+        if code == defines.Commands.RESET_POINTERS[0]:
+            self.reset_pointers()
+            return b''
+        if code == defines.Commands.GETID[0]:
+            return BOARD_ID
+        return b''
+
+    def parse_commands(self):
+        # Parse complete command frames, incomplete tail stays in inbuf
+        while self.inbuf:
+            start = self.inbuf.find(defines.ByteConstants.START)
+            if start < 0:
+                self.inbuf.clear()
+                return
+            del self.inbuf[:start]
+            cmd, i = [], 1
+            while i < len(self.inbuf) and (len(cmd) < 2 or
+                                           len(cmd) < 2 + COMMAND_ARGS.get(cmd[1], 0)):
+                c = self.inbuf[i]
+                if c == defines.ByteConstants.SHIFT:
+                    if i + 1 == len(self.inbuf):
+                        return
+                    c = UNSHIFT_SYMBOL(self.inbuf[i + 1])
+                    i += 1
+                cmd.append(c)
+                i += 1
+            # Checksum and END symbol are not shifted
+            if i + 2 > len(self.inbuf):
+                return
+            del self.inbuf[:i + 2]
+            if cmd[0] == defines.NODE_ADDRESS:
+                self.outbuf += self.reply(cmd[1], cmd[2:])
+
+    def reply(self, code, args):
+        # Framed reply to the command
+        return b_frame(self.execute(code, args))
+
+    """---------------------- FTD2XX INTERFACE --------------------------"""
+
+    def write(self, data):
+        self.inbuf += data
+        self.parse_commands()
+        return len(data)
+
+    def read(self, nchars):
+        data = bytes(self.outbuf[:nchars])
+        del self.outbuf[:nchars]
+        return data
+
+    def resetDevice(self):
+        self.inbuf.clear()
+        self.outbuf.clear()
+        return 0
+
+    def purge(self, mask=0):
+        self.inbuf.clear()
+        self.outbuf.clear()
+        return 0
+
+    def setTimeouts(self, read, write):
+        return 0
+
+    def getDeviceInfo(self):
+        return {'type': self.type, 'id': 0,
+                'description': self.description, 'serial': self.serial}
+
+    def close(self):
+        return 0
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+import numpy as np
+
+from . import tdc_defines as defines
+
+"""====================== STREAMING K-WAY MERGE ======================
+Runs are iterables of structured array batches, each run ordered by
+key. Merge works by batches: events with key below the smallest last
+key among unfinished runs can not be preceded by any later event, so
+they are merged and yielded at once. Runs with this last key read
+their next batch. Merge is stable, on equal keys events of earlier
+runs go first."""
+
+
+def _next_batch(run):
+    # Next nonempty batch of the run or None at its end
+    for batch in run:
+        if len(batch):
+            return batch
+    return None
+
+
+def merge_batches(parts, key='bin'):
+    merged = np.concatenate(parts)
+    return merged[np.argsort(merged[key], kind='stable')]
+
+
+def kway_merge(runs, key='bin'):
+    """Generator of ordered batches merged from ordered runs."""
+    runs = [iter(run) for run in runs]
+    heads = [_next_batch(run) for run in runs]
+    runs = [run for run, head in zip(runs, heads) if head is not None]
+    heads = [head for head in heads if head is not None]
+    live = [True] * len(runs)
+    while any(live):
+        bound = min(head[key][-1] for head, alive in zip(heads, live) if alive)
+        parts = []
+        for i, head in enumerate(heads):
+            split = np.searchsorted(head[key], bound, 'left')
+            if split:
+                parts.append(head[:split])
+            heads[i] = head[split:]
+            if live[i] and head[key][-1] == bound:
+                batch = _next_batch(runs[i])
+                if batch is None:
+                    live[i] = False
+                else:
+                    heads[i] = np.concatenate([heads[i], batch])
+        if parts:
+            yield merge_batches(parts, key)
+    rest = [head for head in heads if len(head)]
+    if rest:
+        yield merge_batches(rest, key)
+
+
+class TExternalSorter:
+    """Orders batches of any size in bounded memory. Every added batch
+    is sorted alone (blocks of TDC6 are nearly ordered), when batches
+    take more than budget bytes they are merged into a sorted run and
+    spilled to a temporary file. Result is the k-way merge of runs."""
+
+    def __init__(self, dtype, key='bin', budget=defines.SORT_MEMORY_BUDGET,
+                 tmpdir=None):
+        self.dtype = np.dtype(dtype)
+        self.key = key
+        self.budget = budget
+        self.tmpdir = tmpdir
+        self.pending = []
+        self.pending_size = 0
+        # Spilled runs, [(fname, count)]
+        self.runs = []
+        self.count = 0
+
+    def add(self, batch):
+        if not len(batch):
+            return
+        self.pending.append(batch[np.argsort(batch[self.key], kind='stable')])
+        self.pending_size += batch.nbytes
+        self.count += len(batch)
+        if self.pending_size >= self.budget:
+            self._spill()
+
+    def _spill(self):
+        if not self.pending:
+            return
+        fd, fname = tempfile.mkstemp(suffix='.run', dir=self.tmpdir)
+        run = merge_batches(self.pending, self.key)
+        with os.fdopen(fd, "wb") as f:
+            run.tofile(f)
+        self.runs.append((fname, len(run)))
+        self.pending, self.pending_size = [], 0
+
+    def _read_run(self, fname, count, chunk):
+        run = np.memmap(fname, self.dtype, 'r', shape=(count,))
+        for start in range(0, count, chunk):
+            yield np.array(run[start:start + chunk])
+
+    def batches(self):
+        """Generator of ordered batches of all added events."""
+        if not self.runs:
+            if self.pending:
+                yield merge_batches(self.pending, self.key)
+            return
+        self._spill()
+        # Every run reads chunks of equal share of the budget
+        chunk = max(1, self.budget // (self.dtype.itemsize * (len(self.runs) + 1)))
+        yield from kway_merge(
+            [self._read_run(fname, count, chunk) for fname, count in self.runs],
+            self.key)
+
+    def close(self):
+        for fname, count in self.runs:
+            os.remove(fname)
+        self.runs = []
+        self.pending, self.pending_size = [], 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
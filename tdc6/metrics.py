@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import bisect
+import threading
+
+from . import tdc_defines as defines
+
+"""========================= RUNTIME METRICS =========================
+Counters, gauges and latency histograms of acquisition stages.
+Hooks are module functions, while metrics are disabled they return
+at once:
+    t = metrics.start()
+    ...
+    metrics.stop("block_read_seconds", t)
+    metrics.inc("bytes_read", size)
+Snapshot is exported as JSON or Prometheus text (by file extension)."""
+
+ENABLED = False
+
+# Upper bounds of latency buckets, seconds
+LATENCY_BUCKETS = tuple(10 ** (e / 4) for e in range(-24, 5))
+
+PROMETHEUS_PREFIX = "tdc6_"
+
+# Counters reported per second of run time too
+RATES = ("bytes_read", "events")
+
+
+class THistogram:
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # Last bucket is for values above all bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return dict(count=self.count, sum=self.sum,
+                    mean=self.sum / self.count if self.count else 0.,
+                    buckets=list(zip(self.bounds, self.counts)) +
+                    [("+Inf", self.counts[-1])])
+
+
+class TMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = THistogram()
+            self.histograms[name].observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            return dict(
+                time=time.time(), elapsed=elapsed,
+                counters=dict(self.counters), gauges=dict(self.gauges),
+                rates={name + "_per_s": self.counters.get(name, 0) / elapsed
+                       for name in RATES if elapsed > 0},
+                histograms={name: h.snapshot() for name, h in self.histograms.items()})
+
+    def prometheus(self):
+        snapshot, lines = self.snapshot(), []
+        for kind, values in (("counter", snapshot["counters"]),
+                             ("gauge", snapshot["gauges"]),
+                             ("gauge", snapshot["rates"])):
+            for name, value in sorted(values.items()):
+                lines += ["# TYPE %s%s %s" % (PROMETHEUS_PREFIX, name, kind),
+                          "%s%s %r" % (PROMETHEUS_PREFIX, name, value)]
+        for name, h in sorted(snapshot["histograms"].items()):
+            name = PROMETHEUS_PREFIX + name
+            lines.append("# TYPE %s histogram" % name)
+            total = 0
+            for bound, count in h["buckets"]:
+                total += count
+                le = bound if bound == "+Inf" else "%.6g" % bound
+                lines.append('%s_bucket{le="%s"} %d' % (name, le, total))
+            lines += ["%s_sum %r" % (name, h["sum"]), "%s_count %d" % (name, h["count"])]
+        return "\n".join(lines) + "\n"
+
+    def write(self, fname):
+        # Written atomically, readers never see a partial snapshot
+        if fname.endswith(".json"):
+            text = json.dumps(self.snapshot(), indent=1)
+        else:
+            text = self.prometheus()
+        with open(fname + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(fname + ".tmp", fname)
+
+
+METRICS = TMetrics()
+
+
+def enable(enabled=True):
+    global ENABLED
+    if enabled and not ENABLED:
+        METRICS.reset()
+    ENABLED = enabled
+
+
+def inc(name, value=1):
+    if ENABLED:
+        METRICS.inc(name, value)
+
+
+def gauge(name, value):
+    if ENABLED:
+        METRICS.gauge(name, value)
+
+
+def start():
+    return time.perf_counter() if ENABLED else None
+
+
+def stop(name, t):
+    if t is not None:
+        METRICS.observe(name, time.perf_counter() - t)
+
+
+class TMetricsExporter:
+    """Thread writing metrics snapshot to fname every interval seconds"""
+
+    def __init__(self, fname, interval=defines.METRICS_INTERVAL, metrics=METRICS):
+        self.fname = fname
+        self.interval = interval
+        self.metrics = metrics
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.metrics.write(self.fname)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.metrics.write(self.fname)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import sys
+
+import numpy as np
+
+from . import tdc_defines as defines
+from .tdc_backend import DEVICE_BINNED_DTYPE, TDCDevice
+from .util import TDataCollector
+from .capture import TCaptureWriter, calibration_id
+from .merge import kway_merge
+
+
+def tag_device(batches, dev):
+    # BINNED_DTYPE batches of one board with the board index
+    for batch in batches:
+        tagged = np.empty(len(batch), DEVICE_BINNED_DTYPE)
+        tagged['bin'] = batch['bin']
+        tagged['ch'] = batch['ch']
+        tagged['dev'] = dev
+        yield tagged
+
+
+class TMultiCollector:
+    """Acquisition from several TDC6 boards at once. Every board is read
+    and decoded by its own workers (see TDataCollector.stream_batches)
+    with its own calibration, batches of the boards are merged into one
+    time-ordered stream of DEVICE_BINNED_DTYPE."""
+
+    def __init__(self, collectors):
+        self.collectors = list(collectors)
+        if len(self.collectors) > 0xff:
+            raise ValueError("MultiCollector: too many devices")
+
+    @classmethod
+    def open(cls, serials, calibration=False):
+        collectors = []
+        for serial in serials:
+            device = TDCDevice(serial=serial)
+            device.reset_pointers()
+            collectors.append(TDataCollector(device, calibration, serial=serial))
+        return cls(collectors)
+
+    @property
+    def serials(self):
+        return [collector.serial for collector in self.collectors]
+
+    def stream_batches(self, events_count=None, timeout=None,
+                       maxsize=defines.STREAM_QUEUE_SIZE):
+        """Generator of time-ordered batches of all boards. events_count
+        is the count for each board. Acquisition of all boards starts
+        together. Merged events are yielded when every board has passed
+        their time, so a silent board holds the stream back until its
+        acquisition ends by events_count or timeout."""
+        streams = []
+        try:
+            for c in self.collectors:
+                streams.append(c.start_stream(events_count, timeout, maxsize=maxsize))
+            yield from kway_merge(
+                tag_device(stream, dev) for dev, stream in enumerate(streams))
+        finally:
+            for stream in streams:
+                stream.close()
+
+    def save_stream(self, fname, events_count=None, timeout=None, **metadata):
+        devices = [dict(serial=c.serial, calibration=calibration_id(c.CAHS))
+                   for c in self.collectors]
+        count = 0
+        with TCaptureWriter(fname, devices=devices, **metadata) as f:
+            for batch in self.stream_batches(events_count, timeout):
+                f.write(batch)
+                count += len(batch)
+                print('.', end="", flush=True)
+        print()
+        sys.stderr.write("%d EVENTS OF %d DEVICES ARE STORED TO '%s'\n" %
+                         (count, len(self.collectors), fname))
+        return count
+
+    def disconnect(self):
+        for collector in self.collectors:
+            collector.device.disconnect()
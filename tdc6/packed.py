@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import lzma
+import zlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import tdc_defines as defines
+from . import metrics
+from .tdc_backend import BINNED_DTYPE, TDC_ERROR_TEMPLATE
+from .capture import (TCalibrationLog, calibration_id, pack_header, read_calibrations,
+                      unpack_header)
+
+"""===================== PACKED CAPTURE FORMAT =====================
+Compact single-file capture of time-ordered BINNED_DTYPE events:
+    header (CAPTURE_HEADER_SIZE bytes, as of binary capture)
+    chunks of PACKED_CHUNK events: CHUNK_FORMAT header + payload
+Payload is compressed LEB128 varints of delta << CHANNEL_BITS | ch,
+delta is the step from the previous timestamp of the chunk, the first
+one goes from the first timestamp in chunk header. Chunks decode
+independently of each other, so they are read in parallel.
+Calibration swaps go to fname.cal, as of binary capture."""
+
+CHANNEL_BITS = 3
+
+# Payload size, events count, first timestamp (ps)
+CHUNK_FORMAT = "<IIq"
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_FORMAT)
+
+CODECS = {
+    "zlib": (lambda data, level: zlib.compress(data, -1 if level is None else level),
+             zlib.decompress),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.decompress)}
+
+
+def b_varint_encode(values):
+    # LEB128 bytes of uint64 values, 7 bits per byte, low bits first
+    values = np.asarray(values, np.uint64)
+    sizes = np.ones(len(values), np.int64)
+    for k in range(1, 10):
+        sizes += values >= np.uint64(1 << 7 * k)
+    starts = np.cumsum(sizes) - sizes
+    data = np.empty(int(sizes.sum()), np.uint8)
+    # Loop over byte positions of values, there are a few of them
+    for k in range(int(sizes.max()) if len(sizes) else 0):
+        has = sizes > k
+        part = (values[has] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        # High bit marks bytes followed by more bytes of the value
+        data[starts[has] + k] = part | (sizes[has] > k + 1).astype(np.uint64) << np.uint64(7)
+    return data.tobytes()
+
+
+def b_varint_decode(data):
+    data = np.frombuffer(data, np.uint8)
+    last = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], last[:-1] + 1])
+    sizes = last - starts + 1
+    values = np.zeros(len(last), np.uint64)
+    for k in range(int(sizes.max()) if len(sizes) else 0):
+        has = sizes > k
+        values[has] |= (data[starts[has] + k] & 0x7f).astype(np.uint64) << np.uint64(7 * k)
+    return values
+
+
+def pack_chunk(binned, codec=defines.PACKED_CODEC, level=None):
+    bins = binned['bin']
+    delta = np.diff(bins, prepend=bins[0])
+    if np.any(delta < 0):
+        raise ValueError(TDC_ERROR_TEMPLATE % "Packed capture: events must be time-ordered")
+    values = delta.astype(np.uint64) << np.uint64(CHANNEL_BITS) | \
+        binned['ch'].astype(np.uint64)
+    payload = CODECS[codec][0](b_varint_encode(values), level)
+    return struct.pack(CHUNK_FORMAT, len(payload), len(binned), int(bins[0])) + payload
+
+
+def unpack_chunk(chunk, codec=defines.PACKED_CODEC):
+    size, count, first = struct.unpack(CHUNK_FORMAT, chunk[:CHUNK_HEADER_SIZE])
+    values = b_varint_decode(CODECS[codec][1](chunk[CHUNK_HEADER_SIZE:]))
+    if len(values) != count:
+        raise ValueError(TDC_ERROR_TEMPLATE % "Packed capture: chunk is corrupted")
+    binned = np.empty(count, BINNED_DTYPE)
+    binned['ch'] = values & np.uint64((1 << CHANNEL_BITS) - 1)
+    binned['bin'] = first + np.cumsum((values >> np.uint64(CHANNEL_BITS)).astype(np.int64))
+    return binned
+
+
+class TPackedWriter:
+    """Writer of time-ordered BINNED_DTYPE batches to a packed capture,
+    codec is a key of CODECS"""
+
+    def __init__(self, fname, cahs=None, codec=defines.PACKED_CODEC, level=None,
+                 chunk=defines.PACKED_CHUNK, **metadata):
+        if codec not in CODECS:
+            raise ValueError(TDC_ERROR_TEMPLATE % "Unknown codec '%s'" % codec)
+        self.fname = fname
+        self.codec = codec
+        self.level = level
+        self.chunk = chunk
+        self.count = 0
+        self.pending = []
+        self.pending_count = 0
+        self.metadata = dict(
+            bin_timelen=defines.BIN_TIMELEN,
+            calibration=calibration_id(cahs),
+            codec=codec,
+            created=time.time(),
+            run=metadata)
+        self.f = open(fname, "wb")
+        self.f.write(pack_header(self.metadata, defines.PACKED_MAGIC))
+        self.calibration_log = TCalibrationLog(fname, cahs)
+
+    def write(self, binned):
+        t = metrics.start()
+        self.calibration_log.check(self.count)
+        self.pending.append(binned[['bin', 'ch']])
+        self.pending_count += len(binned)
+        if self.pending_count >= self.chunk:
+            self._write_chunks(False)
+        self.count += len(binned)
+        metrics.stop("write_seconds", t)
+        metrics.inc("events_written", len(binned))
+
+    def _write_chunks(self, last):
+        pending = np.concatenate(self.pending) if self.pending else np.empty(0, BINNED_DTYPE)
+        n = len(pending) if last else len(pending) - len(pending) % self.chunk
+        for start in range(0, n, self.chunk):
+            self.f.write(pack_chunk(pending[start:min(start + self.chunk, n)],
+                                    self.codec, self.level))
+        self.pending = [pending[n:]]
+        self.pending_count = len(pending) - n
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if not self.f.closed:
+            self._write_chunks(True)
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class TPackedReader:
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as f:
+            self.metadata = unpack_header(
+                f.read(defines.CAPTURE_HEADER_SIZE), defines.PACKED_MAGIC)
+            # (offset, size, count) of every chunk, a truncated one is skipped
+            self.chunks = []
+            offset, end = defines.CAPTURE_HEADER_SIZE, os.path.getsize(fname)
+            while offset + CHUNK_HEADER_SIZE <= end:
+                f.seek(offset)
+                size, count, _ = struct.unpack(CHUNK_FORMAT, f.read(CHUNK_HEADER_SIZE))
+                if offset + CHUNK_HEADER_SIZE + size > end:
+                    break
+                self.chunks.append((offset, CHUNK_HEADER_SIZE + size, count))
+                offset += CHUNK_HEADER_SIZE + size
+        self.codec = self.metadata['codec']
+        self.count = sum(count for _, _, count in self.chunks)
+        self.calibrations = read_calibrations(fname, self.metadata)
+
+    def __len__(self):
+        return self.count
+
+    def chunk(self, i):
+        offset, size, _ = self.chunks[i]
+        with open(self.fname, "rb") as f:
+            f.seek(offset)
+            return unpack_chunk(f.read(size), self.codec)
+
+    def binned(self, workers=None):
+        """All events as BINNED_DTYPE array, chunks are decoded by
+        workers threads (codecs release the GIL)"""
+        if not self.chunks:
+            return np.empty(0, BINNED_DTYPE)
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            return np.concatenate(list(pool.map(self.chunk, range(len(self.chunks)))))
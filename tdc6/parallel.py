@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from . import tdc_defines as defines
+from .tdc_backend import (BINNED_DTYPE, TRecievedData, b_binned, b_extend_rbin,
+                          b_valid_events)
+from .merge import kway_merge
+
+"""=================== PARALLEL DECODING OF RAW BLOCKS ===================
+Frames of all blocks are copied once into shared memory, workers get
+ranges of blocks by offsets. Every worker deframes, decodes and bins
+its blocks as TDataCollector.make_events does and writes the ordered
+result into shared output at the offset of its input (events never
+take more place than their stuffed frames). Timebins are extended over
+rollovers from the first event of every range, ranges after a rollover
+are decoded once more from the last timebin before them (it happens
+once in weeks). Parent merges the ranges."""
+
+# Layout and calibration of worker processes, sent once by pool initializer
+_LAYOUT = {}
+
+
+def _init_worker(in_name, out_name, frames, blocks, cahs):
+    # frames are (start, stop) of frames in input, blocks are indices
+    # of first frames of blocks
+    _LAYOUT.update(in_name=in_name, out_name=out_name, frames=frames,
+                   blocks=blocks, cahs=cahs)
+
+
+def _decode_range(lo, hi, last=-1):
+    # Blocks [lo, hi) to ordered binned events in shared output,
+    # last is extended timebin before the range
+    frames, blocks = _LAYOUT['frames'], _LAYOUT['blocks']
+    shm_in = shared_memory.SharedMemory(_LAYOUT['in_name'])
+    shm_out = shared_memory.SharedMemory(_LAYOUT['out_name'])
+    try:
+        raw = np.ndarray(shm_in.size, np.uint8, shm_in.buf)
+        start = frames[blocks[lo]][0]
+        out = np.ndarray(shm_out.size // BINNED_DTYPE.itemsize, BINNED_DTYPE, shm_out.buf)
+        _d = np.empty(frames[blocks[hi] - 1][1] - start, np.uint8)
+        binned, first = [], None
+        for b in range(lo, hi):
+            n = 0
+            for f_start, f_stop in frames[blocks[b]:blocks[b + 1]]:
+                n += TRecievedData(raw[f_start:f_stop], out=_d[n:]).len
+            n -= n % defines.TIMESTAMP_LEN
+            events = b_valid_events(_d[:n])
+            if len(events):
+                first = int(events['rbin'][0]) if first is None else first
+                events['rbin'] = b_extend_rbin(events['rbin'], last)
+                last = int(events['rbin'][-1])
+            binned.append(b_binned(events, _LAYOUT['cahs']))
+        binned = np.concatenate(binned)
+        binned = binned[np.argsort(binned['bin'], kind='stable')]
+        offset = start // defines.TIMESTAMP_LEN
+        out[offset:offset + len(binned)] = binned
+        del raw, out
+        return offset, len(binned), first, last
+    finally:
+        shm_in.close()
+        shm_out.close()
+
+
+def _split(sizes, parts):
+    # Bounds of consecutive ranges with about equal sum of sizes
+    total = np.cumsum(sizes)
+    bounds = np.searchsorted(total, total[-1] * np.arange(1, parts) / parts, 'right')
+    return np.unique(np.concatenate([[0], bounds, [len(sizes)]]))
+
+
+def parallel_binned(data, cahs, workers=None):
+    """Binned events of raw blocks, as TDataCollector.make_binned_data
+    gives for collector.data, decoded by a pool of processes."""
+    workers = workers or os.cpu_count()
+    data = [d for d in data if sum(len(x) for x in d)]
+    if not data:
+        return np.empty(0, BINNED_DTYPE)
+    lengths = [len(x) for d in data for x in d]
+    stops = np.cumsum(lengths)
+    frames = np.column_stack([stops - lengths, stops]).tolist()
+    blocks = np.cumsum([0] + [len(d) for d in data]).tolist()
+
+    shm_in = shared_memory.SharedMemory(create=True, size=int(stops[-1]))
+    shm_out = shared_memory.SharedMemory(
+        create=True, size=int(stops[-1]) // defines.TIMESTAMP_LEN * BINNED_DTYPE.itemsize + 1)
+    try:
+        raw = np.ndarray(shm_in.size, np.uint8, shm_in.buf)
+        for (start, stop), x in zip(frames, (x for d in data for x in d)):
+            raw[start:stop] = np.frombuffer(x, np.uint8)
+        del raw
+        bounds = _split([sum(len(x) for x in d) for d in data], workers * 4)
+        with ProcessPoolExecutor(
+                workers, initializer=_init_worker,
+                initargs=(shm_in.name, shm_out.name, frames, blocks, cahs)) as pool:
+            ranges = list(pool.map(_decode_range, bounds[:-1].tolist(), bounds[1:].tolist()))
+            # Counter periods before every range follow from its first
+            # event and the end of the previous one
+            last, redo = -1, []
+            for i, (offset, count, first, range_last) in enumerate(ranges):
+                if first is None:
+                    continue
+                shift = int(b_extend_rbin([first], last)[0]) - first
+                if shift:
+                    redo.append((i, last))
+                last = range_last + shift
+            if redo:
+                results = pool.map(_decode_range, *zip(
+                    *[(int(bounds[i]), int(bounds[i + 1]), before) for i, before in redo]))
+                for (i, _), result in zip(redo, results):
+                    ranges[i] = result
+        out = np.ndarray(shm_out.size // BINNED_DTYPE.itemsize, BINNED_DTYPE, shm_out.buf)
+        # Ranges are ordered, merge keeps order of equal timestamps
+        runs = [[out[offset:offset + count]] for offset, count, *_ in ranges]
+        binned = list(kway_merge(runs))
+        binned = np.concatenate(binned) if binned else np.empty(0, BINNED_DTYPE)
+        del out, runs
+        return binned
+    finally:
+        shm_in.close()
+        shm_in.unlink()
+        shm_out.close()
+        shm_out.unlink()
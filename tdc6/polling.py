@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import time
+
+from . import tdc_defines as defines
+from .tdc_backend import UNPACK_NUM
+
+# Weight of the last measurement in byte rate estimation
+RATE_SMOOTHING = 0.3
+# Part of the predicted time to reach the target spent in sleep,
+# the rest covers rate fluctuations and sleep overshoot
+SLEEP_SHARE = 0.5
+
+
+class TPollScheduler:
+    """Decides when to poll BRAM pointers and when to read a block.
+    Incoming byte rate is estimated from write pointer deltas, so blocks
+    are read as large as possible while buffer fill stays below
+    safety_fill. Fill level and laps of the writer are kept for reporting.
+
+    Writer which laps the reader overwrites unread data, so whole
+    BUFF_SIZE buffers are lost. As events are TIMESTAMP_LEN bytes and
+    BUFF_SIZE is not a multiple of it, every lap moves the write pointer
+    by one byte against event boundaries: laps % TIMESTAMP_LEN equals
+    fill % TIMESTAMP_LEN. The rate estimate only has to choose among
+    lap counts TIMESTAMP_LEN apart, so lost bytes are counted exactly.
+    Read of a lapped buffer starts at skip bytes after the read pointer,
+    at the first whole event."""
+
+    def __init__(self, safety_fill=defines.BUFF_SAFETY_FILL,
+                 min_interval=defines.POLL_MIN_INTERVAL,
+                 max_interval=defines.POLL_MAX_INTERVAL,
+                 clock=time.perf_counter):
+        self.safety_size = safety_fill * defines.BUFF_SIZE
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.clock = clock
+        self.rate = 0.
+        self.read_time = 0.
+        self.last_poll = None
+        self.last_read = clock()
+        self.unread = 0
+        self.fill = 0
+        self.max_fill = 0
+        self.polls = 0
+        self.reads = 0
+        self.laps = 0
+        self.full = 0
+        self.skip = 0
+        # Lost by the last poll and in the session
+        self.lost = 0
+        self.lost_bytes = 0
+        self.lost_events = 0
+
+    @staticmethod
+    def count_laps(missing, skip):
+        # Lap count nearest to missing / BUFF_SIZE, equal to skip modulo TIMESTAMP_LEN
+        n = missing / defines.BUFF_SIZE
+        return max(skip + defines.TIMESTAMP_LEN *
+                   round((n - skip) / defines.TIMESTAMP_LEN), skip)
+
+    def update(self, init_r_pointer, curr_w_pointer, now=None):
+        # Returns count of unread bytes of whole events in BRAM,
+        # now is the time when pointers were polled
+        now = self.clock() if now is None else now
+        w_pointer = UNPACK_NUM(curr_w_pointer)
+        fill = (w_pointer - UNPACK_NUM(init_r_pointer)) % defines.BUFF_SIZE
+        skip = fill % defines.TIMESTAMP_LEN
+        laps = skip
+        if self.last_poll is not None:
+            t, last_w_pointer = self.last_poll
+            dt = now - t
+            if dt > 0:
+                laps = self.count_laps(self.unread + self.rate * dt - fill, skip)
+                arrived = (w_pointer - last_w_pointer) % defines.BUFF_SIZE
+                if not self.rate:
+                    self.rate = arrived / dt
+                elif fill >= defines.BUFF_SIZE - defines.TIMESTAMP_LEN - 1:
+                    # Full buffer hides the real rate, it is higher
+                    self.rate = max(min(2 * self.rate, 2 * defines.BUFF_SIZE / dt),
+                                    arrived / dt)
+                else:
+                    self.rate += RATE_SMOOTHING * (arrived / dt - self.rate)
+        if fill >= defines.BUFF_SIZE - defines.TIMESTAMP_LEN:
+            # Board which stops writing when full drops events uncounted
+            self.full += 1
+        self.skip = skip
+        self.laps += laps
+        self._lose(laps * defines.BUFF_SIZE + skip)
+        fill -= skip
+        self.last_poll = now, w_pointer
+        self.unread = fill
+        self.fill = fill
+        self.max_fill = max(self.max_fill, fill)
+        self.polls += 1
+        return fill
+
+    def _lose(self, size):
+        self.lost = size
+        self.lost_bytes += size
+        self.lost_events += size // defines.TIMESTAMP_LEN
+
+    def overrun(self, start_w_pointer):
+        """Check write pointer polled right before the block was read: if
+        the writer had filled the free space, start of the block holds
+        new data and whole block is counted as lost. Returns True for
+        such block."""
+        arrived = (UNPACK_NUM(start_w_pointer) - self.last_poll[1]) % defines.BUFF_SIZE
+        if arrived <= defines.BUFF_SIZE - self.fill - self.skip:
+            return False
+        self._lose(self.fill)
+        return True
+
+    def target(self):
+        # Data coming while block is read must fit under safety margin
+        target = self.safety_size - self.rate * (self.read_time + self.min_interval)
+        return min(max(target, defines.MIN_READ_SIZE), self.safety_size)
+
+    def ready(self, fill):
+        if not fill:
+            return False
+        # Lapped buffer is read at once, the same lap is not counted twice
+        if self.lost:
+            return True
+        return fill >= self.target() or \
+            self.clock() - self.last_read >= self.max_interval
+
+    def delay(self, fill):
+        if self.polls < 2 or not self.rate:
+            return self.min_interval if self.polls < 2 else self.max_interval
+        delay = SLEEP_SHARE * (self.target() - fill) / self.rate
+        return min(max(delay, self.min_interval), self.max_interval)
+
+    def on_read(self, read_time):
+        self.read_time = read_time
+        self.last_read = self.clock()
+        self.unread = 0
+        self.reads += 1
+
+    def report(self):
+        return dict(rate=self.rate, fill=self.fill / defines.BUFF_SIZE,
+                    max_fill=self.max_fill / defines.BUFF_SIZE,
+                    polls=self.polls, reads=self.reads, laps=self.laps,
+                    lost_bytes=self.lost_bytes, lost_events=self.lost_events,
+                    full=self.full)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import struct
+
+import numpy as np
+
+from . import tdc_defines as defines
+from .tdc_backend import TDC_ERROR_TEMPLATE, TDCDevice
+from .capture import calibration_id, channels_fname, pack_header, unpack_header
+from .emulator import TEmulatedDevice, BOARD_ID
+from .polling import TPollScheduler
+
+"""======================== RAW CAPTURE FORMAT ========================
+Blocks of BRAM exactly as received, before any TRecievedData parsing:
+    header (CAPTURE_HEADER_SIZE bytes, as of binary capture)
+    records: RECORD_FORMAT + uint32 lengths of frames + frames
+    fname.cf    CF tables of header calibration, .npz of ch<N> arrays
+Record time is seconds from the start of recording, pointers are the
+bounds of the block read. TReplayDevice serves the records to
+TDCDevice as the board did, so a raw capture is decoded, calibrated
+and binned again by the usual TDataCollector methods."""
+
+# Time, read and write pointers of the block, frames count
+RECORD_FORMAT = "<dHHI"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+
+class TRawWriter:
+
+    def __init__(self, fname, cahs=None, **metadata):
+        self.fname = fname
+        self.count = 0
+        self.size = 0
+        self.metadata = dict(
+            bin_timelen=defines.BIN_TIMELEN,
+            calibration=calibration_id(cahs),
+            created=time.time(),
+            run=metadata)
+        self.f = open(fname, "wb")
+        self.f.write(pack_header(self.metadata, defines.RAW_MAGIC))
+        # Replay bins by the same tables as the run would
+        cf_fname = channels_fname(fname, defines.RAW_CALIBRATION_SUFFIX)
+        if cahs:
+            with open(cf_fname, "wb") as f:
+                np.savez(f, **{"ch%d" % ch: cf for ch, cf in cahs.items()})
+        elif cf_fname != os.devnull and os.path.exists(cf_fname):
+            os.remove(cf_fname)
+        self.started = time.perf_counter()
+
+    def write(self, frames, init_r_pointer, curr_w_pointer):
+        self.f.write(struct.pack(RECORD_FORMAT, time.perf_counter() - self.started,
+                                 init_r_pointer, curr_w_pointer, len(frames)))
+        self.f.write(np.array([len(x) for x in frames], '<u4').tobytes())
+        for x in frames:
+            self.f.write(x)
+        self.count += 1
+        self.size += sum(len(x) for x in frames)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class TRawReader:
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as f:
+            self.metadata = unpack_header(
+                f.read(defines.CAPTURE_HEADER_SIZE), defines.RAW_MAGIC)
+
+    def calibration(self):
+        """CF tables recorded with the capture, None if there are none"""
+        cf_fname = channels_fname(self.fname, defines.RAW_CALIBRATION_SUFFIX)
+        try:
+            with np.load(cf_fname) as tables:
+                cahs = {int(name[2:]): tables[name] for name in tables.files}
+        except FileNotFoundError:
+            return None
+        if calibration_id(cahs) != self.metadata['calibration']:
+            raise ValueError(TDC_ERROR_TEMPLATE %
+                             "Replay: %s does not match the capture" % cf_fname)
+        return cahs
+
+    def blocks(self):
+        """Generator of (time, init_r_pointer, curr_w_pointer, frames),
+        a truncated last record and records without frames are skipped"""
+        with open(self.fname, "rb") as f:
+            f.seek(defines.CAPTURE_HEADER_SIZE)
+            while True:
+                record = f.read(RECORD_SIZE)
+                if len(record) < RECORD_SIZE:
+                    return
+                t, init_r_pointer, curr_w_pointer, count = struct.unpack(
+                    RECORD_FORMAT, record)
+                lengths = np.frombuffer(f.read(4 * count), '<u4')
+                if len(lengths) < count:
+                    return
+                frames = [f.read(int(n)) for n in lengths]
+                if frames and len(frames[-1]) < lengths[-1]:
+                    return
+                if frames:
+                    yield t, init_r_pointer, curr_w_pointer, frames
+
+
+class TReplayDevice(TEmulatedDevice):
+    """Transport serving blocks of a raw capture. Pointers of every
+    block are reported until its frames are read, block reads return
+    recorded frames untouched. clock gives recorded time of the block,
+    see replay_collector. Commands after the last block fail."""
+
+    description = b'TDC6 replay'
+
+    def __init__(self, fname):
+        self.reader = TRawReader(fname)
+        self.blocks = self.reader.blocks()
+        self.block = next(self.blocks, None)
+        self.served = 0
+        # Pointers and time after the last block
+        self.end = 0, 0.
+        serial = self.reader.metadata['run'].get('serial') or 'REPLAY'
+        super().__init__(rates=(), clock=self.recorded_time, serial=serial.encode())
+
+    @property
+    def exhausted(self):
+        return self.block is None
+
+    def recorded_time(self):
+        return self.end[1] if self.block is None else self.block[0]
+
+    def execute(self, code, args):
+        r_pointer, w_pointer = (self.end[0],) * 2 if self.block is None else self.block[1:3]
+        if code == defines.Commands.R_ADDR[0]:
+            # Reported read address is one byte ahead, as of the board
+            return self.pointer(r_pointer + 1)
+        if code == defines.Commands.W_ADDR[0]:
+            return self.pointer(w_pointer)
+        if code == defines.Commands.GETID[0]:
+            return BOARD_ID
+        return b''
+
+    def reply(self, code, args):
+        if code != defines.Commands.R_BRAMBLK[0] or self.block is None:
+            return super().reply(code, args)
+        t, _, w_pointer, frames = self.block
+        frame = frames[self.served]
+        self.served += 1
+        if self.served == len(frames):
+            self.end = w_pointer, t
+            self.block, self.served = next(self.blocks, None), 0
+        return frame
+
+    def write(self, data):
+        if self.block is None:
+            raise EOFError(TDC_ERROR_TEMPLATE % "Replay: end of raw capture")
+        return super().write(data)
+
+
+def replay_collector(fname, calibration=False, serial=None, cahs=None, recorded=True):
+    """TDataCollector of TReplayDevice. Blocks are read as soon as they
+    are decoded, polling follows recorded time. Events are binned by
+    cahs if given, otherwise by the tables recorded with the capture,
+    or by current tables when recorded is False or there are none.
+    calibration is as of TDataCollector, new tables are made then."""
+    from .util import TDataCollector
+    device = TReplayDevice(fname)
+    if cahs is None and recorded and not calibration:
+        cahs = device.reader.calibration()
+    collector = TDataCollector(TDCDevice(transport=device),
+                               calibration or cahs is not None, serial)
+    collector.scheduler = TPollScheduler(safety_fill=0, clock=device.clock)
+    if calibration:
+        return collector
+    if cahs is not None:
+        collector.CAHS = dict(cahs)
+    if calibration_id(collector.CAHS) != device.reader.metadata['calibration']:
+        sys.stderr.write("WARNING: Replay is binned by calibration %s, "
+                         "capture was recorded with %s\n" %
+                         (calibration_id(collector.CAHS), device.reader.metadata['calibration']))
+    return collector
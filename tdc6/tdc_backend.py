@@ -2,9 +2,11 @@
 import time
 from decimal import Decimal, getcontext
 
+import numpy as np
 import ftd2xx as ftd
 from . import tdc_defines as defines
-from .tdc_timeout import SetTimeout, TimeoutError
+from . import metrics
+from .tdc_timeout import Deadline
 # HIGH PRECISION NUMBERS
 getcontext().prec = 28
 
@@ -29,6 +31,8 @@ def UNPACK_NUM(x): return x[0] * 0x100 + x[1]
 
 DEBUG = True
 TIME = False
+# Hex dump of every received frame, slows down reading at high rates
+DUMP = False
 
 """=============== EVENT STRUCTURE AND FOLLOWING ========================="""
 
@@ -49,23 +53,130 @@ def b_errcode(T):
     return (T[-1] & 0b00010000) >> 4
 
 
+EVENT_DTYPE = np.dtype([
+    ('rbin', np.int64),
+    ('ch', np.uint8),
+    ('adcd', np.uint16),
+    ('err', np.bool_)])
+
+
+def b_events(nd):
+    # Whole-array version of b_bin/b_ch/b_adcdata/b_errcode
+    nd = np.asarray(nd, np.uint8).reshape(-1, defines.TIMESTAMP_LEN)
+    events = np.empty(len(nd), EVENT_DTYPE)
+    rbin = np.zeros(len(nd), np.int64)
+    for i in range(6):
+        rbin |= nd[:, i].astype(np.int64) << 8 * i
+    events['rbin'] = rbin
+    events['ch'] = (nd[:, -1] >> 5) + 1
+    events['adcd'] = nd[:, -2] + (nd[:, -1] & 0b00001111).astype(np.uint16) * 256
+    events['err'] = (nd[:, -1] & 0b00010000).astype(np.bool_)
+
+    if np.any((events['ch'] < 1) | (events['ch'] > defines.CHANNELS_NUMBER + 1)):
+        raise ValueError(
+            "Event: Channel number must be in [1, %d]" % (defines.CHANNELS_NUMBER + 1))
+    if np.any(events['rbin'] < 0):
+        raise ValueError("Event: Timebin must be > 0")
+    if np.any(events['adcd'] > defines.ADC_CAPACITY):
+        raise ValueError(
+            "Event: ADC count must be in [0, %d]" % defines.ADC_CAPACITY)
+    return events
+
+
+def b_extend_rbin(rbin, last=-1):
+    """Timebins of RBIN_BITS counter extended over its rollovers.
+    last is extended timebin of the previous event, -1 at session start.
+    Steps back by more than a half of counter period are rollovers,
+    steps forward by more are late events from before a rollover."""
+    period = 1 << defines.RBIN_BITS
+    rbin = np.asarray(rbin, np.int64)
+    if not len(rbin):
+        return rbin
+    start = rbin[0] if last < 0 else last % period
+    base = 0 if last < 0 else last - last % period
+    step = np.diff(rbin, prepend=start)
+    epochs = np.cumsum((step < -period // 2).astype(np.int64) - (step > period // 2))
+    return rbin + base + epochs * period
+
+
+def b_valid_events(nd):
+    events = b_events(nd)
+    return events[~events['err']]
+
+
+BINNED_DTYPE = np.dtype([
+    ('bin', np.int64),
+    ('ch', np.uint8)])
+
+# Binned events of several boards, dev is the board index
+DEVICE_BINNED_DTYPE = np.dtype([
+    ('bin', np.int64),
+    ('ch', np.uint8),
+    ('dev', np.uint8)])
+
+# Fixed-point binning below relies on an integer number of ps per timebin
+BIN_TIMELEN_PS = defines.BIN_TIMELEN * 1e12
+
+
+def b_timestamps(rbin, cf):
+    """Exact int((rbin + cf) * BIN_TIMELEN_PS) as int64 picoseconds.
+    Gives the same numbers as Event.construct_bin: the sum is rounded to
+    float64 as before, then multiplied without rounding in integers."""
+    if BIN_TIMELEN_PS != int(BIN_TIMELEN_PS):
+        raise ValueError("Binning: BIN_TIMELEN must be an integer number of ps")
+    x = np.asarray(rbin, np.int64).astype(np.float64) + cf
+    # |x| = M / 2**s exactly, M < 2**53; int() truncates towards zero
+    m, e = np.frexp(np.abs(x))
+    M = (m * 2.0 ** 53).astype(np.int64)
+    s = 53 - e.astype(np.int64)
+    # M * K overflows int64, so split M into 27 and 26 bit halves
+    K = int(BIN_TIMELEN_PS)
+    A = (M >> 26) * K
+    B = (M & (2 ** 26 - 1)) * K
+    small = (A + (B >> 26)) >> np.clip(s - 26, 0, 63)
+    large = (A << np.clip(26 - s, 0, 63)) + (B >> np.clip(s, 0, 63))
+    return np.where(s >= 26, small, large) * np.where(x < 0, -1, 1)
+
+
+def b_cf_table(cahs):
+    # Stack per-channel CF tables so that table[ch, adcd] is a single lookup
+    table = np.zeros((defines.CHANNELS_NUMBER + 2, defines.ADC_CAPACITY))
+    for ch, cf in cahs.items():
+        table[ch] = cf
+    return table
+
+
+def b_binned(events, cahs):
+    uncalibrated = set(np.unique(events['ch']).tolist()) - set(cahs)
+    if uncalibrated:
+        raise ValueError(
+            TDC_ERROR_TEMPLATE % "\n=== Channel %d is uncalibrated" % min(uncalibrated))
+    cf = b_cf_table(cahs)[events['ch'], events['adcd']]
+    binned = np.empty(len(events), BINNED_DTYPE)
+    binned['bin'] = b_timestamps(events['rbin'], cf)
+    binned['ch'] = events['ch']
+    return binned[np.argsort(binned['bin'], kind='stable')]
+
+
 class Event:
+    """Single event view over one record of EVENT_DTYPE array"""
 
     def __init__(self, T):
         if len(T) != 8:
             raise ValueError("Event: Need 8 bytes to unpack")
-        self.ch = b_ch(T) + 1
-        if self.ch < 1 or self.ch > defines.CHANNELS_NUMBER + 1:
-            raise ValueError(
-                "Event: Channel number must be in [1, %d]" % defines.CHANNELS_NUMBER + 1)
-        self.rbin = b_bin(T)
-        if self.rbin < 0:
-            raise ValueError("Event: Timebin must be > 0")
-        self.adcd = b_adcdata(T)
-        if self.adcd < 0 or self.adcd > defines.ADC_CAPACITY:
-            raise ValueError(
-                "Event: ADC count must be in [0, %d]" % defines.ADC_CAPACITY)
-        self.err = b_errcode(T)
+        self._set_record(b_events(np.frombuffer(bytes(T), np.uint8))[0])
+
+    @classmethod
+    def from_record(cls, rec):
+        self = cls.__new__(cls)
+        self._set_record(rec)
+        return self
+
+    def _set_record(self, rec):
+        self.ch = int(rec['ch'])
+        self.rbin = int(rec['rbin'])
+        self.adcd = int(rec['adcd'])
+        self.err = int(rec['err'])
 
     def construct_bin(self, CF):
         self.bin = int(Decimal(self.rbin + CF[self.adcd]) *
@@ -81,6 +192,10 @@ class Event:
         return "<E ch:%d rbin:%d adcd:%d err:%d>" % (self.ch, self.rbin, self.adcd, self.err)
 
 
+def events_view(events):
+    return [Event.from_record(rec) for rec in events]
+
+
 """========================== COMMAND AND DATA STRUCTURES ========================="""
 
 
@@ -104,51 +219,96 @@ class TCommand:
             yield from r
 
 
+def b_stuff(data):
+    # Replace every special byte c with SHIFT, c - START
+    data = np.frombuffer(bytes(data), np.uint8)
+    special = data >= defines.ByteConstants.START
+    pos = np.arange(len(data)) + np.cumsum(special) - special
+    out = np.empty(len(data) + np.count_nonzero(special), np.uint8)
+    out[pos] = data
+    out[pos[special]] = defines.ByteConstants.SHIFT
+    out[pos[special] + 1] = data[special] - defines.ByteConstants.START
+    return out.tobytes()
+
+
+def b_frame(data):
+    # Frame as the TDC sends it: stuffed data and stuffed checksum
+    data = np.frombuffer(bytes(data), np.uint8)
+    chsum = int(np.bitwise_xor.reduce(data)) if len(data) else 0
+    return bytes([defines.ByteConstants.START]) + b_stuff(data) + \
+        b_stuff([chsum]) + bytes([defines.ByteConstants.END])
+
+
+def b_unstuff(body, out=None):
+    """Unstuff frame body (without START and END) in one pass.
+    Returns data written to the beginning of `out` (a new array if None)
+    and the transmitted checksum."""
+    if len(body) >= 2 and body[-2] == defines.ByteConstants.SHIFT:
+        chsum = UNSHIFT_SYMBOL(int(body[-1]))
+        body = body[:-2]
+    elif len(body) >= 1:
+        chsum = int(body[-1])
+        body = body[:-1]
+    else:
+        raise ValueError(TDC_ERROR_TEMPLATE %
+                         "Bad end symbol in recieved data")
+
+    shifts = np.flatnonzero(body == defines.ByteConstants.SHIFT)
+    escaped = shifts + 1
+    if len(shifts) and (escaped[-1] == len(body) or
+                        np.any(body[escaped] > defines.ByteConstants.SHIFT - defines.ByteConstants.START)):
+        raise ValueError(TDC_ERROR_TEMPLATE %
+                         "Bad shift sequence in recieved data")
+    keep = np.ones(len(body), np.bool_)
+    keep[shifts] = False
+    size = len(body) - len(shifts)
+    if out is None:
+        out = np.empty(size, np.uint8)
+    elif len(out) < size:
+        raise ValueError(TDC_ERROR_TEMPLATE % "Output buffer is too small")
+    data = np.compress(keep, body, out=out[:size])
+    # Escaped bytes move left by the number of SHIFT symbols before them
+    data[escaped - np.arange(1, len(shifts) + 1)] += defines.ByteConstants.START
+    return data, chsum
+
+
 class TRecievedData:
 
-    def __init__(self, _rdata):
+    def __init__(self, _rdata, out=None):
 
         if DEBUG:
             print("RECIEVED DATA LEN", len(_rdata))
+        if DUMP:
             print("RECIEVED DATA", FROM_BYTES(_rdata))
 
-        _rdata = _rdata.split(b'%d' % defines.ByteConstants.END)[0]
+        frame = np.frombuffer(_rdata, np.uint8)
+        end = np.flatnonzero(frame == defines.ByteConstants.END)
+        if len(end):
+            frame = frame[:end[0] + 1]
 
-        if not _rdata:
+        if not len(frame):
             raise ValueError(TDC_ERROR_TEMPLATE %
                              "NULL data recieved. See TDC_WRITE_TIMEOUT")
 
         # First two bytes - node address and command are not shifted
-        if _rdata[0] == defines.ByteConstants.START:
-            _rdata.pop(0)
-        else:
+        if frame[0] != defines.ByteConstants.START:
             raise ValueError(TDC_ERROR_TEMPLATE %
                              "Bad start symbol in recieved data")
-
-        if _rdata[-1] == defines.ByteConstants.END:
-            _rdata.pop()
-            if _rdata[-2] != defines.ByteConstants.SHIFT:
-                chsum = _rdata.pop()
-            else:
-                chsum = UNSHIFT_SYMBOL(_rdata.pop())
-                _rdata.pop()
-        else:
+        if not len(end):
             raise ValueError(TDC_ERROR_TEMPLATE %
                              "Bad end symbol in recieved data")
 
-        self.rdata = bytearray()
-        while _rdata:
-            c = _rdata.pop(0)
-            if c == defines.ByteConstants.SHIFT:
-                self.rdata.append(UNSHIFT_SYMBOL(_rdata.pop(0)))
-            else:
-                self.rdata.append(c)
-        if checksum(self.rdata) != chsum:
-            print(FROM_BYTES(self.rdata))
+        data, chsum = b_unstuff(frame[1:-1], out)
+        data_chsum = int(np.bitwise_xor.reduce(data)) if len(data) else 0
+        if data_chsum != chsum:
+            metrics.inc("checksum_errors")
+            print(FROM_BYTES(data))
             raise ValueError(TDC_ERROR_TEMPLATE %
-                             "Data checksum mismatch %s != %s" % (checksum(self.rdata), chsum))
+                             "Data checksum mismatch %s != %s" % (data_chsum, chsum))
 
-        self.len = len(self.rdata)
+        # Big blocks stay in the caller's buffer, short replies are bytearrays
+        self.rdata = data if out is not None else bytearray(data)
+        self.len = len(data)
 
     def __repr__(self):
         return FROM_BYTES(self.rdata)
@@ -158,18 +318,27 @@ class TRecievedData:
         docs are coming soon"""
 
 
+def open_ftdi(index=0, serial=None):
+    # Boards of a multi-device setup are told apart by serial number
+    try:
+        if serial is not None:
+            return ftd.openEx(serial.encode('utf-8') if isinstance(serial, str) else serial)
+        return ftd.open(index)
+    except Exception as E:
+        raise ftd.DeviceError(USB_ERROR_TEMPLATE % E)
+
+
 class TDCDevice:
 
     device = None
 
     def __init__(self,
                  read_timeout=defines.FTDI_TIMEOUT,
-                 write_timeout=defines.FTDI_TIMEOUT):
-        # Connect to first FTDI chip in devices list
-        try:
-            self.device = ftd.open(0)
-        except Exception as E:
-            raise ftd.DeviceError(USB_ERROR_TEMPLATE % E)
+                 write_timeout=defines.FTDI_TIMEOUT,
+                 transport=None, serial=None):
+        # Transport is any object with ftd2xx.FTD2XX interface,
+        # by default FTDI chip with the serial or the first one in devices list
+        self.device = transport if transport is not None else open_ftdi(0, serial)
 
         if self.device.type == ftd.defines.DEVICE_2232H:
             print("=== FTDI 2232H is used ===")
@@ -184,30 +353,32 @@ class TDCDevice:
         if self.device.resetDevice():
             raise ftd.DeviceError(
                 USB_ERROR_TEMPLATE % (OP_ERR % "FT_ResetDevice"))
-        if self.device.purge():
-            raise ftd.DeviceError(
-                USB_ERROR_TEMPLATE % (OP_ERR % "FT_Purge"))
+        self.purge()
         # set RX/TX timeouts
         if self.device.setTimeouts(read_timeout, write_timeout):
             raise ftd.DeviceError(
                 USB_ERROR_TEMPLATE % (OP_ERR % "FT_SetTimeouts"))
+        self.rx_buffer = bytearray(defines.RX_BUFFER_SIZE)
         #self.device.setBaudRate(int(2 * 10**6))
 
-    def _cmd_exchange(self, cmd, data_size, *args):
+    def _cmd_exchange(self, cmd, data_size, *args, timeout=defines.READ_TIMEOUT):
         if TIME:
             t = time.time()
+        t_metrics = metrics.start()
         cmd = TCommand(cmd, *args)
         self.write(cmd.cmd)
         if TIME:
             print("C", time.time() - t)
-        return self.read(data_size)
+        data = self.read(data_size, timeout)
+        metrics.stop("command_roundtrip_seconds", t_metrics)
+        return data
 
     def cmd_exchange(self, cmd, *args, data_size=16):
         data = self._cmd_exchange(cmd, data_size, *args)
         return TRecievedData(data).rdata
 
-    def read_cmd_exchange(self, cmd, *args, data_size):
-        return self._cmd_exchange(cmd, data_size, *args)
+    def read_cmd_exchange(self, cmd, *args, data_size, timeout=defines.READ_TIMEOUT):
+        return self._cmd_exchange(cmd, data_size, *args, timeout=timeout)
 
     def write(self, cmd):
         try:
@@ -219,19 +390,62 @@ class TDCDevice:
             raise ftd.DeviceError(
                 USB_ERROR_TEMPLATE % ('Error in writing cmd "%s": %s' % (FROM_BYTES(cmd), E)))
 
-    def read(self, data_size):
+    def read(self, data_size, timeout=defines.READ_TIMEOUT):
+        # Single frame, empty if the deadline is expired
         if TIME:
             t = time.time()
-        try:
-            data = bytearray(self.device.read(2 * data_size))
-            if defines.ByteConstants.END not in data:
-                while defines.ByteConstants.END not in data:
-                    data += self.device.read(data_size)
-        except TimeoutError:
-            return bytearray()
+        frames = self.read_frames(1, data_size, timeout)
         if TIME:
             print("T", time.time() - t)
-        return data.split(b'%d' % defines.ByteConstants.END)[0]
+        return frames[0] if frames else bytearray()
+
+    def read_frames(self, frames_count, data_size, timeout=defines.READ_TIMEOUT):
+        """Read frames_count reply frames into the reusable receive buffer.
+        Returns memoryview slices, which are valid until the next read.
+        Reply stream of pipelined commands is split by END symbols, which
+        are never shifted inside frames. Every device.read waits no more
+        than FTDI read timeout, so the deadline is checked with
+        millisecond resolution. Rest of the reply after an expired
+        deadline is purged, so it is not taken for the next replies."""
+        deadline = Deadline(timeout)
+        buf, size, ends = self.rx_buffer, 0, []
+        chunk_size = 2 * data_size
+        while len(ends) < frames_count and not deadline.expired():
+            chunk = self.device.read(chunk_size)
+            chunk_size = data_size
+            if not chunk:
+                continue
+            if size + len(chunk) > len(buf):
+                # New buffer, so views given out before stay valid
+                buf = bytearray(2 * (size + len(chunk)))
+                buf[:size] = self.rx_buffer[:size]
+                self.rx_buffer = buf
+            buf[size:size + len(chunk)] = chunk
+            # Only the new bytes are scanned
+            end = buf.find(defines.ByteConstants.END, size, size + len(chunk))
+            while end >= 0 and len(ends) < frames_count:
+                ends.append(end)
+                end = buf.find(defines.ByteConstants.END, end + 1, size + len(chunk))
+            size += len(chunk)
+        if len(ends) < frames_count:
+            self.purge()
+        view = memoryview(buf)
+        starts = [0] + [end + 1 for end in ends[:-1]]
+        return [view[start:end + 1] for start, end in zip(starts, ends)]
+
+    def purge(self):
+        if self.device.purge():
+            raise ftd.DeviceError(
+                USB_ERROR_TEMPLATE % (OP_ERR % "FT_Purge"))
+
+    def pipeline_exchange(self, cmds, data_size=16, timeout=defines.READ_TIMEOUT):
+        """Send (cmd, args) commands in one USB write and return raw reply
+        frames. Frames missing due to the deadline are not returned."""
+        t = metrics.start()
+        self.write(b''.join(TCommand(cmd, *args).cmd for cmd, args in cmds))
+        frames = self.read_frames(len(cmds), data_size, timeout)
+        metrics.stop("command_roundtrip_seconds", t)
+        return frames
 
     def reset_pointers(self):
         return self.cmd_exchange(defines.Commands.RESET_POINTERS)
@@ -239,43 +453,83 @@ class TDCDevice:
     def get_init_r_pointer(self):
         return self.cmd_exchange(defines.Commands.R_ADDR)
 
-    def get_curr_w_pointer(self):
-        cwp1, cwp2 = self.cmd_exchange(defines.Commands.W_ADDR)
+    @staticmethod
+    def _w_pointer(rdata):
+        cwp1, cwp2 = rdata
         # Cous of the first bit is always zero
         return bytearray([cwp1 & 0x7f, cwp2])
 
-    def _read_bramblock(self, init_r_pointer, curr_w_pointer):
+    def get_curr_w_pointer(self):
+        return self._w_pointer(self.cmd_exchange(defines.Commands.W_ADDR))
+
+    def get_pointers(self):
+        # Read and write pointers in one round trip
+        frames = self.pipeline_exchange(
+            [(defines.Commands.R_ADDR, []), (defines.Commands.W_ADDR, [])])
+        if len(frames) < 2:
+            raise ValueError(TDC_ERROR_TEMPLATE %
+                             "NULL data recieved. See TDC_WRITE_TIMEOUT")
+        return (TRecievedData(frames[0]).rdata,
+                self._w_pointer(TRecievedData(frames[1]).rdata))
+
+    @staticmethod
+    def _bramblock_cmd(init_r_pointer, curr_w_pointer):
         data_size = UNPACK_NUM(curr_w_pointer) - UNPACK_NUM(init_r_pointer)
-        byte_data_size = bytearray([data_size // 0x100, data_size % 0x100])
+        byte_data_size = [data_size // 0x100, data_size % 0x100]
         if DEBUG:
             print(">> DATA SIZE", data_size)
             print(">> TEST POINTERS", FROM_BYTES(
                 curr_w_pointer), FROM_BYTES(init_r_pointer))
-        try:
-            if TIME:
-                t = time.time()
-            with SetTimeout(defines.MAX_READ_TIMEOUT):
-                d = self.read_cmd_exchange(defines.Commands.R_BRAMBLK,
-                                           *init_r_pointer,
-                                           *byte_data_size,
-                                           data_size=data_size)
-            if TIME:
-                print("D", time.time() - t)
-        except TimeoutError:
-            return bytearray(), True
-        return d, False
+        return (defines.Commands.R_BRAMBLK, [*init_r_pointer, *byte_data_size]), data_size
 
-    def read_bramblock(self, init_r_pointer, curr_w_pointer):
+    def _read_bramblocks(self, init_r_pointer, curr_w_pointer, poll):
         t = time.time()
+        t_metrics = metrics.start()
         if curr_w_pointer < init_r_pointer:
-            d1, err1 = self._read_bramblock(
-                init_r_pointer, defines.HADDR_BOUND)
-            d2, err2 = self._read_bramblock(
-                defines.LADDR_BOUND, curr_w_pointer)
-            return [d1, d2], err1 | err2, time.time() - t
+            bounds = [(init_r_pointer, defines.HADDR_BOUND),
+                      (defines.LADDR_BOUND, curr_w_pointer)]
         elif curr_w_pointer > init_r_pointer:
-            d, err = self._read_bramblock(init_r_pointer, curr_w_pointer)
-            return [d], err, time.time() - t
+            bounds = [(init_r_pointer, curr_w_pointer)]
+        else:
+            return [], False, 0., None
+        if len(bounds) > 1:
+            metrics.inc("wrapped_reads")
+        cmds, sizes = zip(*[self._bramblock_cmd(*b) for b in bounds])
+        cmds = list(cmds)
+        if poll:
+            # Write pointer at the start of the read shows overwritten data
+            cmds = [(defines.Commands.W_ADDR, [])] + cmds + \
+                [(defines.Commands.R_ADDR, []), (defines.Commands.W_ADDR, [])]
+        frames = self.pipeline_exchange(cmds, data_size=sum(sizes),
+                                        timeout=defines.MAX_READ_TIMEOUT)
+        if TIME:
+            print("D", time.time() - t)
+        # Missing frames mean the read deadline is expired
+        err = len(frames) < len(cmds)
+        d = frames[int(poll):int(poll) + len(bounds)]
+        metrics.stop("block_read_seconds", t_metrics)
+        if err:
+            metrics.inc("read_timeouts")
+        else:
+            metrics.inc("bytes_read", sum(sizes))
+        pointers = None
+        if poll and not err:
+            pointers = (TRecievedData(frames[-2]).rdata,
+                        self._w_pointer(TRecievedData(frames[-1]).rdata),
+                        self._w_pointer(TRecievedData(frames[0]).rdata))
+        return d, err, time.time() - t, pointers
+
+    def read_bramblock(self, init_r_pointer, curr_w_pointer):
+        # Both halves of a wrapped block are read in one round trip
+        d, err, t, _ = self._read_bramblocks(init_r_pointer, curr_w_pointer, False)
+        return d, err, t
+
+    def poll_bramblock(self, init_r_pointer, curr_w_pointer):
+        """Read block and query new pointers in one round trip.
+        Returns data, error flag, time and pointers (None on error):
+        read and write pointers after the block and write pointer
+        before it."""
+        return self._read_bramblocks(init_r_pointer, curr_w_pointer, True)
 
     def connected(self):
         return self.device.status
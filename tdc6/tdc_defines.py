@@ -4,6 +4,7 @@ import os
 
 MAX_PACKET_SIZE = 0x40
 BUFF_SIZE = 0x7fff
+RX_BUFFER_SIZE = 4 * BUFF_SIZE  # fits a stuffed full BRAM block with replies
 LADDR_BOUND = bytearray([0x00] * 2)
 HADDR_BOUND = bytearray([0x7f, 0xff])
 FTDI_TIMEOUT = 1  # milliseconds
@@ -11,14 +12,45 @@ TDC_WRITE_TIMEOUT = 5  # seconds
 NODE_ADDRESS = 0x01
 
 TIMESTAMP_LEN = 8
+RBIN_BITS = 48  # width of timebin counter of the board
 BIN_TIMELEN = 12.5e-9
 ADC_CAPACITY = 2 ** 12
 HIST_CAPACITY = 100000
 CHANNELS_NUMBER = 4
-
-MAX_READ_TIMEOUT = 2
-
-CALIBRATION_HELPER = os.path.join("CAH", "%d.calibration_helper")
+COINCIDENCE_WINDOW = 20000  # ps
+COINCIDENCE_BINS = 351
+ONLINE_CALIBRATION_DRIFT = 1e-3  # max CF change in timebins before refresh
+
+READ_TIMEOUT = 0.1  # seconds, command reply deadline
+MAX_READ_TIMEOUT = 0.5  # seconds, BRAM block deadline
+
+POLL_MIN_INTERVAL = 0.0005  # seconds
+POLL_MAX_INTERVAL = 0.05  # seconds, also max latency of data at low rates
+MIN_READ_SIZE = 0x400  # bytes
+BUFF_SAFETY_FILL = 0.75  # part of BRAM which may be filled before reading
+STREAM_QUEUE_SIZE = 16  # blocks and batches waiting for processing
+SORT_MEMORY_BUDGET = 0x10000000  # bytes of events sorted in memory
+METRICS_INTERVAL = 1.  # seconds between metrics snapshots
+
+CALIBRATION_HELPER = os.path.join("CAH", "%d.calibration_helper")  # former pickles
+CALIBRATION_TABLE = os.path.join("CAH", "%d.cft")
+DEVICE_CALIBRATION_TABLE = os.path.join("CAH", "%s", "%d.cft")  # by board serial
+CALIBRATION_MAGIC = b'TDC6CFT\x00'
+CALIBRATION_VERSION = 1
+
+CAPTURE_MAGIC = b'TDC6CAP\x00'
+CAPTURE_VERSION = 1
+CAPTURE_HEADER_SIZE = 0x1000  # keeps timestamps column aligned
+CAPTURE_CHANNELS_SUFFIX = ".ch"
+CAPTURE_DEVICES_SUFFIX = ".dev"
+CAPTURE_INDEX_SUFFIX = ".idx"
+CAPTURE_CALIBRATION_SUFFIX = ".cal"
+CAPTURE_INDEX_CHUNK = 0x10000  # events per indexed chunk
+PACKED_MAGIC = b'TDC6PAK\x00'
+PACKED_CODEC = "zlib"
+PACKED_CHUNK = 0x10000  # events per compressed chunk
+RAW_MAGIC = b'TDC6RAW\x00'
+RAW_CALIBRATION_SUFFIX = ".cf"
 
 
 class TConstants:
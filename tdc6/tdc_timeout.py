@@ -1,26 +1,16 @@
 # -*- coding: utf-8 -*-
-import signal
+import time
 
 
-"""====================== TIMEOUT EXCEPTION ========================"""
+"""========================= READ DEADLINE ========================="""
 
 
-class TimeoutError(Exception):
-    pass
+class Deadline:
+    """Monotonic deadline for I/O loops. Unlike SIGALRM it has sub-second
+    resolution and works in any thread."""
 
+    def __init__(self, seconds=1):
+        self.expires = time.monotonic() + seconds
 
-class SetTimeout:
-
-    def __init__(self, seconds=1, error_message='Timeout'):
-        self.seconds = seconds
-        self.error_message = error_message
-
-    def handle_timeout(self, signum, frame):
-        raise TimeoutError(self.error_message)
-
-    def __enter__(self):
-        signal.signal(signal.SIGALRM, self.handle_timeout)
-        signal.alarm(self.seconds)
-
-    def __exit__(self, type, value, traceback):
-        signal.alarm(0)
+    def expired(self):
+        return time.monotonic() >= self.expires
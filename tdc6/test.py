@@ -1,28 +1,132 @@
 # -*- coding: utf-8 -*-
-import os
+import sys
+import time
+import itertools
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-from matplotlib import pyplot as plt
+
+from . import tdc_defines as defines
+from .tdc_backend import (BINNED_DTYPE, TDC_ERROR_TEMPLATE, TDCDevice, b_binned,
+                          b_timestamps, events_view)
+from .emulator import TEmulatedDevice
+from .calibration import make_cf_table, make_histogram
+from .coincidence import TCoincidenceCounter
+
+# Window of device function test, ps
+TEST_WINDOW = 1000
+
+
+def histogram_FWHM(events, ch1, ch2, window=defines.COINCIDENCE_WINDOW):
+    counter = TCoincidenceCounter([(ch1, ch2)], window)
+    counter.update(events)
+    return counter.fwhm(ch1, ch2)
+
+
+def check_timestamps(count=100000, seed=0):
+    """b_timestamps against Decimal arithmetic of Event.construct_bin
+    for random and boundary (rbin, cf), no board is needed"""
+    rng = np.random.default_rng(seed)
+    edges_rbin = [0, 1, 2 ** 47, 2 ** defines.RBIN_BITS - 1, 2 ** defines.RBIN_BITS,
+                  2 ** (defines.RBIN_BITS + 1)]
+    edges_cf = [0., np.nextafter(0., 1.), 1 / 3, 0.5, np.nextafter(1., 0.), 1.]
+    edges = np.array(list(itertools.product(edges_rbin, edges_cf)))
+    rbin = np.concatenate([rng.integers(0, 2 ** defines.RBIN_BITS + 1, count),
+                           edges[:, 0].astype(np.int64)])
+    cf = np.concatenate([rng.random(count), edges[:, 1]])
+    # Same expression as Event.construct_bin
+    expected = np.array([int(Decimal(r + c) * Decimal(defines.BIN_TIMELEN * 1e12))
+                         for r, c in zip(rbin.tolist(), cf)], np.int64)
+    mismatches = np.count_nonzero(b_timestamps(rbin, cf) != expected)
+    if mismatches:
+        raise ValueError(TDC_ERROR_TEMPLATE % "Binning mismatch in %d timestamps" % mismatches)
+    return len(expected)
+
+
+def check_replay(events_count=200000, seed=0):
+    """Raw capture of the emulated board, with a block lost by forced
+    overrun, is replayed to the events of the recorded blocks"""
+    import os
+    import tempfile
+    from .bench import emulated_collector
+    from .raw import TRawReader, replay_collector
+    collector = emulated_collector([1e5] * defines.CHANNELS_NUMBER, seed)
+    scheduler, overrun = collector.scheduler, collector.scheduler.overrun
+
+    def forced_overrun(start_w_pointer):
+        # The third block is lost as if the writer had reached it
+        if scheduler.reads == 2:
+            scheduler._lose(scheduler.fill)
+            return True
+        return overrun(start_w_pointer)
+    scheduler.overrun = forced_overrun
+    fname = os.path.join(tempfile.mkdtemp(), "replay.raw")
+    collector.record_raw(fname, events_count)
+    if not collector.losses:
+        raise ValueError(TDC_ERROR_TEMPLATE % "Replay: overrun is not forced")
+    collector.data = [frames for *_, frames in TRawReader(fname).blocks()]
+    collector.collect_events_data()
+    collector.make_binned_data()
+    # Replay bins by the tables recorded with the capture
+    replay = replay_collector(fname)
+    replay.read_replay()
+    replay.collect_events_data()
+    replay.make_binned_data()
+    os.remove(fname)
+    os.remove(fname + defines.RAW_CALIBRATION_SUFFIX)
+    if not np.array_equal(replay.binned_data, collector.binned_data):
+        raise ValueError(TDC_ERROR_TEMPLATE % "Replay: events differ from recorded ones")
+    return len(replay.binned_data)
+
+
+class TStalledDevice(TEmulatedDevice):
+    """Emulated board behind a slow link: for the first stall seconds
+    replies come by 64 bytes per 2 ms"""
+
+    def __init__(self, stall, **kwargs):
+        super().__init__(**kwargs)
+        self.stall_end = self.clock() + stall
+
+    def read(self, nchars):
+        if self.clock() < self.stall_end:
+            time.sleep(0.002)
+            nchars = min(nchars, 64)
+        return super().read(nchars)
 
 
-def FWHM(X, Y):
-    half_max = np.max(Y) / 2.
-    # find when function crosses line half_max (when sign of diff flips)
-    # take the 'derivative' of signum(half_max - Y[])
-    d = np.where(Y - half_max >= 0)
-    # find the left and right most indexes
-    return X[d[0]] - X[d[-1]]
+def check_stalled_read(events_count=100000, seed=0):
+    """Block read of the emulated board stalled past the read deadline
+    fails alone, the next blocks are read and decoded"""
+    from .util import TDataCollector
+    tdc = TDCDevice(transport=TStalledDevice(
+        2 * defines.MAX_READ_TIMEOUT, rates=[1e5] * defines.CHANNELS_NUMBER, seed=seed))
+    tdc.reset_pointers()
+    collector = TDataCollector(tdc, calibration=True)
+    failed = 0
+    while events_count > 0:
+        d, err, t = collector.read_by_pointers()
+        failed += err
+        events_count -= len(collector.make_events(d))
+    if not failed:
+        raise ValueError(TDC_ERROR_TEMPLATE % "Stalled read: deadline is not expired")
+    return failed
 
 
-def histogram_FWHM(events, ch1, ch2):
-    timelist = []
-    for i in range(len(events) - 1):
-        if events[i].ch == ch1 and events[i + 1].ch == ch2:
-            timelist.append(events[i].bin - events[i + 1].bin)
-            if events[i].ch == ch2 and events[i + 1].ch == ch1:
-                timelist.append(events[i + 1].bin - events[i].bin)
-    times = np.array(timelist)
-    hist, bins = np.histogram(times, bins=351)
-    return FWHM(bins, hist)
+# Data shared by calibration sweep workers, sent once per process
+_SWEEP = {}
+
+
+def _init_sweep(adcd, test_events, ch1, ch2):
+    _SWEEP.update(adcd=adcd, test_events=test_events, chs=(ch1, ch2))
+
+
+def _sweep_width(n):
+    # Calibrate by first n events of every channel and test
+    ch1, ch2 = _SWEEP['chs']
+    cahs = {ch: make_cf_table(make_histogram(_SWEEP['adcd'][ch][:n]))
+            for ch in (ch1, ch2)}
+    return histogram_FWHM(b_binned(_SWEEP['test_events'], cahs), ch1, ch2)
 
 
 class TDeviceTests:
@@ -31,31 +135,91 @@ class TDeviceTests:
         self.tdevice = tdc_thread
 
     def get_test_data(self, ch1, ch2, data_size):
+        self.tdevice.clear_data()
         self.tdevice.read_by_count(data_size)
         self.tdevice.collect_events_data()
         self.tdevice.make_binned_data()
-        chs_edata = [
-            e for e in self.tdevice.events_data
-            if e.ch == ch1 or e.ch == ch2]
-        chs_edata.sort(key=lambda x: x.bin)
-        return chs_edata
+        binned = self.tdevice.binned_data
+        return binned[(binned['ch'] == ch1) | (binned['ch'] == ch2)]
 
-    def test_device_function(self, ch1, ch2, data_size=5000):
+    def test_device_function(self, ch1, ch2, data_size=5000, window=TEST_WINDOW):
         chs_edata = self.get_test_data(ch1, ch2, data_size)
+        counter = TCoincidenceCounter([(ch1, ch2)], window)
+        counter.update(chs_edata)
+        hist, bins = counter.histogram(ch1, ch2)
 
-        temp_file = "chan[%d,%d]_diff_data.txt" % (ch1, ch2)
-        lines = ['\t'.join(T.unpack()) for T in chs_edata]
-        with open(temp_file, "w") as f:
-            f.write('\n'.join(lines))
-        os.system("python histogram.py %s --start=-1 --end=1" % temp_file)
-
-    def test_calibration_capacity(self, n_from, n_to, step=10000, ch1=1, ch2=2):
-        hwidths = []
-        for n in range(n_from, n_to, step):
-            self.tdevice.make_cf("%d%d" % (ch1, ch2), N=n)
-            self.tdevice._get_calibration_helpers()
-            chs_edata = self.get_test_data(ch1, ch2, n)
-            width = histogram_FWHM(chs_edata, ch1, ch2)
-            hwidths.append(width)
-        plt.plot(np.arange(n_from, n_to, step), hwidths)
+        temp_file = "chan[%d,%d]_diff_hist.txt" % (ch1, ch2)
+        np.savetxt(temp_file, np.column_stack([bins[:-1], hist]),
+                   fmt="%d", delimiter="\t")
+        print("FWHM %s ps" % counter.fwhm(ch1, ch2))
+        from matplotlib import pyplot as plt
+        plt.plot(bins[:-1], hist)
         plt.show()
+
+    def test_binning(self, data_size=5000):
+        # Vectorized binning must reproduce Event.construct_bin exactly
+        self.tdevice.clear_data()
+        self.tdevice.read_by_count(data_size)
+        self.tdevice.collect_events_data()
+        self.tdevice.make_binned_data()
+        events = events_view(self.tdevice.events_data)
+        for T in events:
+            T.construct_bin(self.tdevice.CAHS[T.ch])
+        events.sort(key=lambda x: x.bin)
+        expected = np.array([(T.bin, T.ch) for T in events], BINNED_DTYPE)
+        if not np.array_equal(expected, self.tdevice.binned_data):
+            raise ValueError(TDC_ERROR_TEMPLATE % "Binning mismatch")
+        return len(expected)
+
+    def test_calibration_capacity(self, n_from, n_to, step=10000, ch1=1, ch2=2,
+                                  data_size=None, workers=None):
+        """FWHM of ch1-ch2 histogram vs calibration size. One acquisition
+        gives calibration events (nested subsamples for every size) and
+        data_size events to test, sizes are processed in parallel."""
+        data_size = data_size or n_to
+        self.tdevice.clear_data()
+        # Other channels take their share of events, so reading goes on
+        # until both channels have n_to calibration events
+        count = 2 * n_to + data_size
+        while True:
+            self.tdevice.read_by_count(count)
+            self.tdevice.collect_events_data()
+            events = self.tdevice.events_data
+            chs_events = events[(events['ch'] == ch1) | (events['ch'] == ch2)]
+            calibration = chs_events[:-data_size]
+            counts = [np.count_nonzero(calibration['ch'] == ch) for ch in (ch1, ch2)]
+            if min(counts) >= n_to:
+                break
+            scarce = min(np.count_nonzero(chs_events['ch'] == ch) for ch in (ch1, ch2))
+            if not scarce or self.tdevice.exhausted:
+                raise ValueError(TDC_ERROR_TEMPLATE %
+                                 "Not enough events of channels %d, %d for calibration "
+                                 "size %d: %d, %d" % (ch1, ch2, n_to, *counts))
+            # Missing events in proportion to the share of the scarcer channel
+            count = int((n_to - min(counts)) * len(events) / scarce) + data_size
+        test_events = chs_events[-data_size:]
+        adcd = {ch: calibration['adcd'][calibration['ch'] == ch] for ch in (ch1, ch2)}
+
+        sizes = np.arange(n_from, n_to, step)
+        with ProcessPoolExecutor(workers, initializer=_init_sweep,
+                                 initargs=(adcd, test_events, ch1, ch2)) as pool:
+            hwidths = list(pool.map(_sweep_width, sizes.tolist()))
+        from matplotlib import pyplot as plt
+        plt.plot(sizes, hwidths)
+        plt.show()
+        return sizes, hwidths
+
+
+if __name__ == "__main__":
+    # Offline checks: exact binning, also of emulated board data
+    from .bench import emulated_collector, quiet
+    sys.stderr.write("%d TIMESTAMPS ARE BINNED EXACTLY\n" % check_timestamps())
+    with quiet():
+        count = TDeviceTests(emulated_collector([1e5] * defines.CHANNELS_NUMBER)).test_binning()
+    sys.stderr.write("%d EMULATED EVENTS ARE BINNED EXACTLY\n" % count)
+    with quiet():
+        count = check_replay()
+    sys.stderr.write("%d EVENTS ARE REPLAYED FROM RAW CAPTURE\n" % count)
+    with quiet():
+        count = check_stalled_read()
+    sys.stderr.write("%d STALLED BLOCK READS ARE SKIPPED\n" % count)
@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 import time
 import sys
-import pickle
-import asyncio
-import itertools
+import queue
+import threading
 
 import numpy as np
 
 from . import tdc_defines as defines
-from .tdc_backend import Event, TDC_ERROR_TEMPLATE, TRecievedData
-from .calibration import TCalibrationHelper
+from . import metrics
+from .tdc_backend import (EVENT_DTYPE, BINNED_DTYPE, BIN_TIMELEN_PS,
+                          TDC_ERROR_TEMPLATE, UNPACK_NUM, TRecievedData,
+                          b_binned, b_events, b_extend_rbin)
+from .calibration import TCalibrationHelper, calibration_table, load_calibration
+from .capture import TCaptureWriter
+from .packed import TPackedWriter
+from .coincidence import TCoincidenceCounter, TRateCounter
+from .polling import TPollScheduler
 
 
 DEBUG = True
@@ -18,24 +24,39 @@ DEBUG = True
 class TDataCollector:
 
     CAHS = {}
-    data = []
-    events_data = []
 
-    def __init__(self, tdc_device, calibration=False):
+    def __init__(self, tdc_device, calibration=False, serial=None):
         self.device = tdc_device
+        # Collector of a board with serial has own calibration,
+        # the others share the class one
+        self.serial = serial
+        if serial is not None:
+            self.CAHS = {}
+        self.clear_data()
+        self.scheduler = TPollScheduler()
+        self.pointers = None
+        # perf_counter of the first block read, start-up time is measured by it
+        self.first_read = None
+        # Data lost by writer laps, [(read number, bytes, events)]
+        self.losses = []
+        # Extended timebin of the last decoded event, see b_extend_rbin
+        self.rbin_last = -1
+        # TOnlineCalibration to refresh CAHS from acquired events
+        self.online_calibration = None
+        # TExternalSorter to keep binned events instead of raw blocks
+        self.sorter = None
+        # Bounds of the last block read, see read_by_pointers
+        self.block_pointers = None
+        # Processes to decode raw blocks of save_data, see parallel_binned
+        self.decode_workers = None
         if not calibration:
             self._get_calibration_helpers()
 
     def _get_calibration_helpers(self):
         for ch in range(1, defines.CHANNELS_NUMBER + 1):
             try:
-                with open(defines.CALIBRATION_HELPER % ch, "rb") as f:
-                    cur_helper = pickle.load(f)
-                if not any(cur_helper.histogram):
-                    raise IndexError
-                self.CAHS[ch] = np.vectorize(cur_helper.CF)(
-                    np.arange(defines.ADC_CAPACITY))
-            except (FileNotFoundError, IndexError) as E:
+                self.CAHS[ch] = load_calibration(ch, self.serial).cf
+            except (FileNotFoundError, ValueError) as E:
                 sys.stderr.write(
                     TDC_ERROR_TEMPLATE % """
                     There are no calibration data for channel %d:
@@ -44,67 +65,445 @@ class TDataCollector:
                     """ % (ch, E, ch))
                 sys.exit()
 
-    def get_pointers(self):
-        init_r_pointer = self.device.get_init_r_pointer()
+    def _available_calibration(self):
+        cahs = {}
+        for ch in range(1, defines.CHANNELS_NUMBER + 1):
+            try:
+                cahs[ch] = load_calibration(ch, self.serial).cf
+            except (FileNotFoundError, ValueError):
+                pass
+        return cahs
+
+    @staticmethod
+    def _fix_pointers(init_r_pointer, curr_w_pointer):
         #!!!TODO:HACK TO NEUTRALIZE BAD START BYTE
-        if init_r_pointer[1] > 0:
-            init_r_pointer[1] -= 1
-        curr_w_pointer = self.device.get_curr_w_pointer()
+        irp = UNPACK_NUM(init_r_pointer)
+        if irp > 0:
+            init_r_pointer[:] = [(irp - 1) // 0x100, (irp - 1) % 0x100]
         return init_r_pointer, curr_w_pointer
 
-    def read_by_pointers(self):
+    def clear_data(self):
+        # Acquired data are per collector, calibration is shared
+        self.data = []
+        self.events_data = np.empty(0, EVENT_DTYPE)
+        self.binned_data = np.empty(0, BINNED_DTYPE)
+
+    def get_pointers(self):
+        return self._fix_pointers(*self.device.get_pointers())
+
+    @staticmethod
+    def _advance(pointer, n):
+        p = (UNPACK_NUM(pointer) + n) % defines.BUFF_SIZE
+        return bytearray([p // 0x100, p % 0x100])
+
+    def read_by_pointers(self, stop=None):
+        """Wait for a block ready to read and read it. stop is a predicate
+        checked while BRAM is filling, when it holds an empty block is
+        returned. Pointers polled with the previous block save a round trip"""
         while True:
-            ip, cp = self.get_pointers()
-            d1, d2 = map(lambda x: x[0] - x[1], zip(cp, ip))
-            delta = d1 * 0x100 + d2
-            if delta > 1000 * defines.TIMESTAMP_LEN or cp < ip:
-                return self.device.read_bramblock(ip, cp)
+            # Pointers left from a paused acquisition are stale, data
+            # between them may be overwritten already
+            if self.pointers is None or \
+                    self.scheduler.clock() - self.pointers[2] > defines.POLL_MAX_INTERVAL:
+                self.pointers = (*self.get_pointers(), self.scheduler.clock())
+            ip, cp, polled = self.pointers
+            self.pointers = None
+            fill = self.scheduler.update(ip, cp, polled)
+            metrics.gauge("bram_fill", fill / defines.BUFF_SIZE)
+            metrics.gauge("bram_laps", self.scheduler.laps)
+            if self.scheduler.lost:
+                self._on_lost()
+            if self.scheduler.skip:
+                # Overwritten buffer is read from the first whole event
+                ip = self._advance(ip, self.scheduler.skip)
+            if self.scheduler.ready(fill):
+                # Bounds of the block, kept by raw recording
+                self.block_pointers = UNPACK_NUM(ip), UNPACK_NUM(cp)
+                d, err, t, pointers = self.device.poll_bramblock(ip, cp)
+                # Failed read leaves no pointers, the next call polls them
+                if pointers is not None:
+                    self.pointers = (*self._fix_pointers(*pointers[:2]), self.scheduler.clock())
+                    if self.scheduler.overrun(pointers[2]):
+                        self._on_lost()
+                        d = []
+                self.scheduler.on_read(t)
+                if self.first_read is None:
+                    self.first_read = time.perf_counter()
+                # Device receive buffer is reused by the next read
+                return [bytes(x) for x in d], err, t
+            if stop is not None and stop():
+                return [], False, 0.
+            time.sleep(self.scheduler.delay(fill))
+
+    def _on_lost(self):
+        lost = self.scheduler.lost
+        self.losses.append((self.scheduler.reads, lost, lost // defines.TIMESTAMP_LEN))
+        metrics.inc("lost_bytes", lost)
+        metrics.inc("lost_events", lost // defines.TIMESTAMP_LEN)
+        if DEBUG:
+            print("\nBRAM OVERWRITTEN: %d bytes are lost" % lost)
+
+    def report_polling(self):
+        report = self.scheduler.report()
+        if DEBUG:
+            print("POLLING", report)
+        if report['lost_bytes']:
+            sys.stderr.write(
+                "WARNING: BRAM overflow, writer lapped reader %d times, "
+                "%d bytes (%d events) are lost\n" %
+                (report['laps'], report['lost_bytes'], report['lost_events']))
+        elif report['full']:
+            sys.stderr.write(
+                "WARNING: BRAM was full %d times, events may be dropped\n" % report['full'])
+        return report
+
+    def _store(self, d):
+        # With sorter memory is bound by its budget, not by run length
+        if self.sorter is None:
+            self.data.append(d)
+        else:
+            self.sorter.add(self._binned(self.make_events(d)))
+
+    @property
+    def exhausted(self):
+        # Only a replayed raw capture comes to its end, see raw.TReplayDevice
+        return getattr(self.device.device, 'exhausted', False)
 
     def read_by_count(self, events_count=defines.BUFF_SIZE / defines.TIMESTAMP_LEN):
-        while events_count > 0:
+        while events_count > 0 and not self.exhausted:
             d, err, t = self.read_by_pointers()
             if err:
                 continue
-            self.data.append(d)
+            self._store(d)
             events_count -= len(b''.join(d)) // defines.TIMESTAMP_LEN
             print('.', end="", flush=True)
         print()
+        self.report_polling()
 
     def read_by_timeout(self, timeout):
-        while timeout > 0:
-            timeout += time.time()
-            d, err, t = self.read_by_pointers()
-            timeout -= time.time()
+        deadline = time.time() + timeout
+
+        def expired():
+            return time.time() > deadline
+        while not expired() and not self.exhausted:
+            d, err, t = self.read_by_pointers(expired)
             if err:
                 if DEBUG:
                     print("\nNo data. Terminated by timeout\n")
                 continue
-            self.data.append(d)
+            if not d:
+                continue
+            self._store(d)
             print('.', end="", flush=True)
         print()
+        self.report_polling()
 
-    async def _make_events_data(self, d):
-        _d = b''.join(TRecievedData(x).rdata for x in d)
-        _d = _d[:-(len(_d) % defines.TIMESTAMP_LEN)]
-        nd = np.frombuffer(_d, np.uint8).reshape(-1, defines.TIMESTAMP_LEN)
+    def record_raw(self, fname, events_count=None, timeout=None, **metadata):
+        """Minimal-overhead acquisition: blocks are written to a raw
+        capture as received, nothing is decoded. See raw.replay_collector"""
+        from .raw import TRawWriter
+        deadline = time.time() + timeout if timeout else None
+        # Recording does not need calibration, tables at hand are kept
+        cahs = self.CAHS or self._available_calibration()
 
-        evd = [Event(t) for t in nd]
-        evd = [T for T in evd if not T.err]
-        self.events_data.append(evd)
+        def expired():
+            return deadline is not None and time.time() > deadline
+        with TRawWriter(fname, cahs, **metadata) as f:
+            while events_count is None or events_count > 0:
+                if expired():
+                    break
+                d, err, t = self.read_by_pointers(expired)
+                # Block lost by overrun has no frames to record
+                if err or not d:
+                    continue
+                f.write(d, *self.block_pointers)
+                if events_count is not None:
+                    events_count -= sum(len(x) for x in d) // defines.TIMESTAMP_LEN
+                print('.', end="", flush=True)
+        print()
+        self.report_polling()
+        sys.stderr.write("%d BLOCKS (%d BYTES) ARE RECORDED TO '%s'\n" %
+                         (f.count, f.size, fname))
+
+    def read_replay(self):
+        # All blocks of the raw capture of replay_collector
+        while not self.exhausted:
+            d, err, t = self.read_by_pointers()
+            if not err:
+                self._store(d)
+        self.report_polling()
+
+    def make_events(self, d):
+        t = metrics.start()
+        _d = np.empty(sum(len(x) for x in d), np.uint8)
+        n = 0
+        for x in d:
+            n += TRecievedData(x, out=_d[n:]).len
+        n -= n % defines.TIMESTAMP_LEN
+        metrics.stop("deframe_seconds", t)
+        t = metrics.start()
+        events = b_events(_d[:n])
+        if metrics.ENABLED:
+            errors = int(np.count_nonzero(events['err']))
+            metrics.inc("events", len(events) - errors)
+            metrics.inc("error_events_dropped", errors)
+        events = events[~events['err']]
+        events['rbin'] = b_extend_rbin(events['rbin'], self.rbin_last)
+        if len(events):
+            self.rbin_last = int(events['rbin'][-1])
+        metrics.stop("decode_seconds", t)
+        if self.online_calibration is not None:
+            self.online_calibration.update(events, self.CAHS)
+        return events
 
     def collect_events_data(self):
-        collecting_loop = asyncio.get_event_loop()
-        tasks = asyncio.gather(*[self._make_events_data(d) for d in self.data])
-        collecting_loop.run_until_complete(tasks)
-        self.events_data = list(itertools.chain(*self.events_data))
+        # Every pass decodes the session from its start
+        self.rbin_last = -1
+        events_data = [self.make_events(d) for d in self.data]
+        if events_data:
+            self.events_data = np.concatenate(events_data)
+        else:
+            self.events_data = np.empty(0, EVENT_DTYPE)
+
+    def _binned(self, events):
+        t = metrics.start()
+        binned = b_binned(events, self.CAHS)
+        metrics.stop("bin_seconds", t)
+        return binned
 
     def make_binned_data(self):
-        for T in self.events_data:
-            if T.ch not in self.CAHS.keys():
-                raise ValueError(
-                    TDC_ERROR_TEMPLATE % "\n=== Channel %d is uncalibrated" % T.ch)
-            T.construct_bin(self.CAHS[T.ch])
-        self.events_data.sort(key=lambda x: x.bin)
+        self.binned_data = self._binned(self.events_data)
+
+    """===================== STREAMING ACQUISITION ====================="""
+
+    @staticmethod
+    def _put(q, item, stop):
+        # Wait for a free place but give up when the stream is stopped
+        while not stop.is_set():
+            try:
+                return q.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+
+    @staticmethod
+    def _get(q, stop):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    @staticmethod
+    def _stop_predicate(stop, timeout):
+        # Stream is over when stop is set or timeout seconds elapse
+        deadline = time.time() + timeout if timeout else None
+
+        def stopped():
+            return stop.is_set() or deadline is not None and time.time() > deadline
+        return stopped
+
+    def _read_blocks(self, blocks, stop, events_count, timeout):
+        stopped = self._stop_predicate(stop, timeout)
+        try:
+            while not stopped() and not self.exhausted:
+                if events_count is not None and events_count <= 0:
+                    break
+                d, err, t = self.read_by_pointers(stopped)
+                if err or not d:
+                    continue
+                if events_count is not None:
+                    events_count -= sum(len(x) for x in d) // defines.TIMESTAMP_LEN
+                self._put(blocks, d, stop)
+        except Exception as E:
+            self._put(blocks, E, stop)
+        self.report_polling()
+        self._put(blocks, None, stop)
+
+    def _order_events(self, events, carry):
+        # Events of the next blocks can not be earlier than the last
+        # timebin of this one, later events wait for them in carry.
+        # Returns ordered batch ready to go and new carry
+        batch = np.concatenate([carry, self._binned(events)])
+        batch = batch[np.argsort(batch['bin'], kind='stable')]
+        watermark = int(events['rbin'].max()) * int(BIN_TIMELEN_PS)
+        split = np.searchsorted(batch['bin'], watermark)
+        return batch[:split], batch[split:]
+
+    def _decode_blocks(self, blocks, batches, stop, binned):
+        carry = np.empty(0, BINNED_DTYPE)
+        try:
+            while True:
+                d = self._get(blocks, stop)
+                if d is None or isinstance(d, Exception):
+                    if len(carry):
+                        self._put(batches, carry, stop)
+                    self._put(batches, d, stop)
+                    return
+                events = self.make_events(d)
+                if not binned:
+                    self._put(batches, events, stop)
+                    continue
+                if not len(events):
+                    continue
+                batch, carry = self._order_events(events, carry)
+                if len(batch):
+                    self._put(batches, batch, stop)
+        except Exception as E:
+            self._put(batches, E, stop)
+
+    def stream_batches(self, events_count=None, timeout=None, binned=True,
+                       maxsize=defines.STREAM_QUEUE_SIZE):
+        """Generator of event batches decoded while acquisition goes on.
+        Batches are time-ordered arrays of BINNED_DTYPE if binned,
+        otherwise arrays of EVENT_DTYPE. Runs until events_count events
+        are read, timeout seconds elapse or the generator is closed."""
+        yield from self.start_stream(events_count, timeout, binned, maxsize)
+
+    def start_stream(self, events_count=None, timeout=None, binned=True,
+                     maxsize=defines.STREAM_QUEUE_SIZE):
+        """stream_batches with reader and decoder started at once, not at
+        the first batch. Closing the generator stops them, also before
+        the first batch."""
+        stream = self._stream_batches(events_count, timeout, binned, maxsize)
+        next(stream)
+        return stream
+
+    def _stream_batches(self, events_count, timeout, binned, maxsize):
+        blocks, batches = queue.Queue(maxsize), queue.Queue(maxsize)
+        stop = threading.Event()
+        workers = [
+            threading.Thread(target=self._read_blocks, daemon=True,
+                             args=(blocks, stop, events_count, timeout)),
+            threading.Thread(target=self._decode_blocks, daemon=True,
+                             args=(blocks, batches, stop, binned))]
+        for worker in workers:
+            worker.start()
+        try:
+            # Workers are running, see start_stream
+            yield
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+    """======================= ASYNC ACQUISITION ======================="""
+
+    async def _stream_reads(self, blocks, events_count, timeout, executor, state):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        stopped = self._stop_predicate(state['stop'], timeout)
+        try:
+            while events_count is None or events_count > 0:
+                if stopped() or self.exhausted:
+                    break
+                # Shielded so that cancelled stream still waits for the
+                # blocking read, device can not be shared by two reads.
+                # Cancelled stream sets stop, so the read does not wait for data
+                state['read'] = loop.run_in_executor(executor, self.read_by_pointers, stopped)
+                d, err, t = await asyncio.shield(state['read'])
+                if err or not d:
+                    continue
+                if events_count is not None:
+                    events_count -= sum(len(x) for x in d) // defines.TIMESTAMP_LEN
+                await blocks.put(d)
+        except Exception as E:
+            await blocks.put(E)
+        self.report_polling()
+        await blocks.put(None)
+
+    async def stream(self, events_count=None, timeout=None, binned=True,
+                     maxsize=defines.STREAM_QUEUE_SIZE, executor=None):
+        """Async generator of event batches, same as stream_batches:
+            async for batch in collector.stream(timeout=10): ...
+        Blocking reads and decoding run in executor (default one of the
+        loop), so the loop is free for consumers. Slow consumer stops
+        reading when maxsize blocks are waiting. Closing or cancelling
+        the generator stops acquisition."""
+        # asyncio takes most of import time, headless runs go without it
+        import asyncio
+        loop = asyncio.get_running_loop()
+        blocks = asyncio.Queue(maxsize)
+        state = dict(stop=threading.Event())
+        reader = asyncio.ensure_future(
+            self._stream_reads(blocks, events_count, timeout, executor, state))
+        carry = np.empty(0, BINNED_DTYPE)
+        try:
+            while True:
+                d = await blocks.get()
+                if isinstance(d, Exception):
+                    raise d
+                if d is None:
+                    break
+                events = await loop.run_in_executor(executor, self.make_events, d)
+                if not binned:
+                    yield events
+                    continue
+                if not len(events):
+                    continue
+                batch, carry = await loop.run_in_executor(
+                    executor, self._order_events, events, carry)
+                if len(batch):
+                    yield batch
+            if len(carry):
+                yield carry
+        finally:
+            state['stop'].set()
+            reader.cancel()
+            await asyncio.gather(reader, return_exceptions=True)
+            if 'read' in state:
+                await asyncio.gather(state['read'], return_exceptions=True)
+
+    def stream_to(self, sink, **kwargs):
+        count = 0
+        for batch in self.stream_batches(**kwargs):
+            sink(batch)
+            count += len(batch)
+        return count
+
+    def save_stream(self, fname, events_count=None, timeout=None, text=False,
+                    **metadata):
+        if text:
+            f = open(fname, "w")
+
+            def write(batch):
+                f.write(''.join('%d\t%d\n' % T for T in batch.tolist()))
+        else:
+            f = TCaptureWriter(fname, self.CAHS, **metadata)
+            write = f.write
+        with f:
+            def sink(batch):
+                write(batch)
+                print('.', end="", flush=True)
+            count = self.stream_to(
+                sink, events_count=events_count, timeout=timeout)
+        print()
+        sys.stderr.write("%d EVENTS ARE STORED TO '%s'\n" % (count, fname))
+
+    def histogram_stream(self, pairs, events_count=None, timeout=None,
+                         window=defines.COINCIDENCE_WINDOW,
+                         bins=defines.COINCIDENCE_BINS):
+        """Histogram-only acquisition: streamed batches are accumulated
+        into histograms of channel pairs and rates of channels and then
+        dropped, so memory does not grow with acquisition time.
+        Returns TCoincidenceCounter and TRateCounter."""
+        counter = TCoincidenceCounter(pairs, window, bins)
+        rates = TRateCounter()
+
+        def sink(batch):
+            counter.update(batch)
+            rates.update(batch)
+            print('.', end="", flush=True)
+        count = self.stream_to(sink, events_count=events_count, timeout=timeout)
+        print()
+        sys.stderr.write("%d EVENTS ARE HISTOGRAMMED\n" % count)
+        return counter, rates
 
     def make_cf(self, chs, N=defines.HIST_CAPACITY):
         chs = [int(c) for c in chs]
@@ -113,17 +512,40 @@ class TDataCollector:
 
         for ch in chs:
             cfc = TCalibrationHelper(ch, self.events_data)
-            with open(defines.CALIBRATION_HELPER % ch, 'wb') as store_file:
-                pickle.dump(cfc, store_file)
+            cfc.save(calibration_table(ch, self.serial))
             sys.stderr.write("HELPER FOR CHANNEL %d IS STORED\n" % ch)
 
-    def save_data(self, fname):
-        self.collect_events_data()
-        self.make_binned_data()
+    def _binned_batches(self):
+        if self.sorter is not None:
+            yield from self.sorter.batches()
+            return
+        if self.decode_workers and self.online_calibration is None:
+            from .parallel import parallel_binned
+            self.binned_data = parallel_binned(self.data, self.CAHS, self.decode_workers)
+        else:
+            self.collect_events_data()
+            self.make_binned_data()
+        yield self.binned_data
 
-        lines = ['\t'.join(T.unpack()) for T in self.events_data]
-        with open(fname, "w") as f:
-            f.write('\n'.join(lines))
+    def save_data(self, fname, text=False, codec=None, **metadata):
+        # codec selects packed capture, see packed.CODECS
+        count = 0
+        if text:
+            with open(fname, "w") as f:
+                for batch in self._binned_batches():
+                    lines = ['%d\t%d' % T for T in batch.tolist()]
+                    f.write(('\n' if count else '') + '\n'.join(lines))
+                    count += len(batch)
+        else:
+            if codec:
+                f = TPackedWriter(fname, self.CAHS, codec, **metadata)
+            else:
+                f = TCaptureWriter(fname, self.CAHS, **metadata)
+            with f:
+                for batch in self._binned_batches():
+                    f.write(batch)
+                    count += len(batch)
+        if self.sorter is not None:
+            self.sorter.close()
 
-        sys.stderr.write("%d EVENTS ARE STORED TO '%s'\n" %
-                         (len(lines), fname))
+        sys.stderr.write("%d EVENTS ARE STORED TO '%s'\n" % (count, fname))
@@ -3,86 +3,222 @@ import sys
 import time
 import argparse
 
+# Start of the process for time-to-first-read report
+LAUNCH_TIME = time.perf_counter()
+
 import ftd2xx
 
 import tdc6.util as tdc6util
+import tdc6.calibration as tdc6calibration
 import tdc6.tdc_backend as tdc_backend
-import tdc6.test as tdc6test
-
-if __name__ != "__main__":
-    sys.exit()
-
-sys.stderr.write("=========================================================\n")
-ARGS = argparse.ArgumentParser()
-ARGS.add_argument(
-    "--fname",
-    default='/dev/null',
-    help="File to save obtained data",
-    type=str)
-ARGS.add_argument(
-    "-t", "--timeout",
-    help="Time for reading process, s",
-    type=float)
-ARGS.add_argument(
-    "-n", "--count",
-    help="Reading events count",
-    type=int)
-ARGS.add_argument(
-    "-c", "--calibration",
-    help="Channels for calibration",
-    type=str)
-ARGS.add_argument(
-    "--test",
-    help="Do self-testing",
-    type=str)
-ARGS = ARGS.parse_args()
-
-if not ftd2xx.listDevices():
-    sys.stderr.write(tdc_backend.USB_ERROR_TEMPLATE %
-                     "Device is not found. Check your cable\n")
-    sys.exit()
-
-TDC = tdc_backend.TDCDevice()
-if not TDC.connected():
-    sys.exit()
-
-sys.stderr.write("TDC (SN %s) is connected\n" %
-                 TDC.device_info()['serial'].decode('utf-8'))
-
-# Commands to prepare device: reset read and write pointers
-try:
-    TDC.reset_pointers()
-except Exception as E:
-    sys.stderr.write(tdc_backend.TDC_ERROR_TEMPLATE % (
-        "Can not reset pointers: \n=== %s\n=== Check installation\n" % E))
-    sys.exit()
-
-r = tdc6util.TDataCollector(TDC, ARGS.calibration)
-
-start_time = time.time()
-if ARGS.fname == '/dev/null':
-    sys.stderr.write("WARNING: All data will be save in /dev/null\n")
-if ARGS.count:
-    r.read_by_count(ARGS.count)
-elif ARGS.timeout:
-    r.read_by_timeout(ARGS.timeout)
-elif ARGS.calibration:
-    sys.stderr.write(
-        "\nCALIBRATION OF CHANNELS %s IS IN PROGRESS...\n" % ','.join(ARGS.calibration))
-    r.make_cf(ARGS.calibration)
-    sys.stderr.write(
-        "\nCALIBRATION DATA FOR CHANNELS %s IS STORED\n" % ','.join(ARGS.calibration))
-elif ARGS.test:
-    ch1, ch2 = map(int, ARGS.test)
-    t = tdc6test.TDeviceTests(r)
-    #t.test_device_function(ch1, ch2)
-    t.test_calibration_capacity(1000, 100000, step=10000, ch1=ch1, ch2=ch2)
-    TDC.disconnect()
-    sys.exit()
 
 
-sys.stderr.write("PASS TIME %.2f SECONDS\n" % (time.time() - start_time))
-if not ARGS.calibration:
-    r.save_data(ARGS.fname)
+def main():
+    sys.stderr.write("=========================================================\n")
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument(
+        "--fname",
+        default='/dev/null',
+        help="File to save obtained data",
+        type=str)
+    ARGS.add_argument(
+        "--text",
+        help="Save data as text instead of binary capture",
+        action="store_true")
+    ARGS.add_argument(
+        "--codec",
+        help="Save data as packed capture compressed by codec",
+        choices=["zlib", "lzma"])
+    ARGS.add_argument(
+        "-t", "--timeout",
+        help="Time for reading process, s",
+        type=float)
+    ARGS.add_argument(
+        "-n", "--count",
+        help="Reading events count",
+        type=int)
+    ARGS.add_argument(
+        "-c", "--calibration",
+        help="Channels for calibration",
+        type=str)
+    ARGS.add_argument(
+        "--raw",
+        help="Record blocks as received to fname, without decoding",
+        action="store_true")
+    ARGS.add_argument(
+        "--replay",
+        help="Raw capture to process instead of the board, with its recorded calibration",
+        type=str)
+    ARGS.add_argument(
+        "--recalibrate",
+        help="Bin replayed raw capture by current calibration",
+        action="store_true")
+    ARGS.add_argument(
+        "--stream",
+        help="Decode and save data during acquisition",
+        action="store_true")
+    ARGS.add_argument(
+        "--memory-budget",
+        help="Memory for sorting of events, MB, larger runs are sorted on disk",
+        type=float)
+    ARGS.add_argument(
+        "--workers",
+        help="Processes to decode acquired data",
+        type=int)
+    ARGS.add_argument(
+        "--histograms",
+        help="Histogram-only acquisition of channel pairs, e.g. 12,34; "
+             "histograms are saved to fname as .npz",
+        type=str)
+    ARGS.add_argument(
+        "--online-calibration",
+        help="Refresh calibration from acquired data and store it",
+        action="store_true")
+    ARGS.add_argument(
+        "--devices",
+        help="Serial numbers of boards for multi-device acquisition, comma separated",
+        type=str)
+    ARGS.add_argument(
+        "--metrics",
+        help="File for runtime metrics snapshots, JSON for *.json, Prometheus text otherwise",
+        type=str)
+    ARGS.add_argument(
+        "--plot",
+        help="Show histograms of calibration",
+        action="store_true")
+    ARGS.add_argument(
+        "--test",
+        help="Do self-testing",
+        type=str)
+    ARGS = ARGS.parse_args()
+    tdc6calibration.PLOT = ARGS.plot
+
+    if ARGS.metrics:
+        import atexit
+        import tdc6.metrics as tdc6metrics
+        tdc6metrics.enable()
+        # Last snapshot is written on any exit
+        atexit.register(tdc6metrics.TMetricsExporter(ARGS.metrics).start().stop)
+
+    if not ARGS.replay and not ftd2xx.listDevices():
+        sys.stderr.write(tdc_backend.USB_ERROR_TEMPLATE %
+                         "Device is not found. Check your cable\n")
+        return
+
+    if ARGS.devices:
+        # Every board is calibrated alone, acquisition is streamed and merged
+        import tdc6.multi as tdc6multi
+        M = tdc6multi.TMultiCollector.open(ARGS.devices.split(','), ARGS.calibration)
+        start_time = time.time()
+        if ARGS.calibration:
+            for r in M.collectors:
+                sys.stderr.write("\nCALIBRATION OF TDC (SN %s)...\n" % r.serial)
+                r.make_cf(ARGS.calibration)
+        else:
+            M.save_stream(ARGS.fname, events_count=ARGS.count, timeout=ARGS.timeout)
+        sys.stderr.write("PASS TIME %.2f SECONDS\n" % (time.time() - start_time))
+        M.disconnect()
+        return
+
+    if ARGS.replay:
+        # Recorded blocks come through the usual pipeline
+        import tdc6.raw as tdc6raw
+        r = tdc6raw.replay_collector(ARGS.replay, ARGS.calibration,
+                                     recorded=not ARGS.recalibrate)
+        TDC = r.device
+        SERIAL = TDC.device_info()['serial'].decode('utf-8')
+        sys.stderr.write("REPLAY OF TDC (SN %s) FROM '%s'\n" % (SERIAL, ARGS.replay))
+    else:
+        TDC = tdc_backend.TDCDevice()
+        if not TDC.connected():
+            return
+
+        SERIAL = TDC.device_info()['serial'].decode('utf-8')
+        sys.stderr.write("TDC (SN %s) is connected\n" % SERIAL)
+
+        # Commands to prepare device: reset read and write pointers
+        try:
+            TDC.reset_pointers()
+        except Exception as E:
+            sys.stderr.write(tdc_backend.TDC_ERROR_TEMPLATE % (
+                "Can not reset pointers: \n=== %s\n=== Check installation\n" % E))
+            return
+
+        # Raw recording goes without valid calibration, see record_raw
+        r = tdc6util.TDataCollector(
+            TDC, ARGS.calibration or ARGS.raw and not (ARGS.histograms or ARGS.stream))
+    if ARGS.online_calibration and not ARGS.calibration:
+        r.online_calibration = tdc6calibration.TOnlineCalibration()
+    r.decode_workers = ARGS.workers
+    if ARGS.memory_budget and not ARGS.calibration and not ARGS.test:
+        import tdc6.merge as tdc6merge
+        r.sorter = tdc6merge.TExternalSorter(
+            tdc_backend.BINNED_DTYPE, budget=int(ARGS.memory_budget * 2**20))
+
+    start_time = time.time()
+    if ARGS.fname == '/dev/null':
+        sys.stderr.write("WARNING: All data will be save in /dev/null\n")
+    if ARGS.histograms and not ARGS.calibration:
+        import tdc6.coincidence as tdc6coincidence
+        counter, rates = r.histogram_stream(
+            [tuple(map(int, pair)) for pair in ARGS.histograms.split(',')],
+            events_count=ARGS.count, timeout=ARGS.timeout)
+        for ch1, ch2 in counter.pairs:
+            sys.stderr.write("FWHM [%d,%d] %s ps\n" % (ch1, ch2, counter.fwhm(ch1, ch2)))
+        for ch, rate in rates.rates().items():
+            sys.stderr.write("RATE [%d] %.1f 1/s\n" % (ch, rate))
+        tdc6coincidence.save_histograms(ARGS.fname, counter, rates)
+        sys.stderr.write("PASS TIME %.2f SECONDS\n" % (time.time() - start_time))
+        TDC.disconnect()
+        return
+    elif ARGS.stream and not ARGS.calibration:
+        r.save_stream(ARGS.fname, events_count=ARGS.count, timeout=ARGS.timeout,
+                      text=ARGS.text, serial=SERIAL)
+        if r.online_calibration is not None:
+            r.online_calibration.save()
+        sys.stderr.write("PASS TIME %.2f SECONDS\n" % (time.time() - start_time))
+        if r.first_read is not None:
+            sys.stderr.write("FIRST READ AFTER %.3f SECONDS\n" % (r.first_read - LAUNCH_TIME))
+        TDC.disconnect()
+        return
+    elif ARGS.raw and not ARGS.calibration:
+        r.record_raw(ARGS.fname, events_count=ARGS.count, timeout=ARGS.timeout, serial=SERIAL)
+        sys.stderr.write("PASS TIME %.2f SECONDS\n" % (time.time() - start_time))
+        TDC.disconnect()
+        return
+    elif ARGS.count:
+        r.read_by_count(ARGS.count)
+    elif ARGS.timeout:
+        r.read_by_timeout(ARGS.timeout)
+    elif ARGS.calibration:
+        sys.stderr.write(
+            "\nCALIBRATION OF CHANNELS %s IS IN PROGRESS...\n" % ','.join(ARGS.calibration))
+        r.make_cf(ARGS.calibration)
+        sys.stderr.write(
+            "\nCALIBRATION DATA FOR CHANNELS %s IS STORED\n" % ','.join(ARGS.calibration))
+    elif ARGS.replay and not ARGS.test:
+        r.read_replay()
+    elif ARGS.test:
+        # Analysis and plotting are loaded for tests only
+        import tdc6.test as tdc6test
+        ch1, ch2 = map(int, ARGS.test)
+        t = tdc6test.TDeviceTests(r)
+        #t.test_device_function(ch1, ch2)
+        t.test_calibration_capacity(1000, 100000, step=10000, ch1=ch1, ch2=ch2)
+        TDC.disconnect()
+        return
+
+
+    sys.stderr.write("PASS TIME %.2f SECONDS\n" % (time.time() - start_time))
+    if r.first_read is not None:
+        sys.stderr.write("FIRST READ AFTER %.3f SECONDS\n" % (r.first_read - LAUNCH_TIME))
+    if not ARGS.calibration:
+        r.save_data(ARGS.fname, text=ARGS.text, codec=ARGS.codec, serial=SERIAL)
+        if r.online_calibration is not None:
+            r.online_calibration.save()
+
+    TDC.disconnect()
+
 
-TDC.disconnect()
+if __name__ == "__main__":
+    main()